@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from config_util import get_settings
+from logger import logger
+from redis_util import get_redis
+
+
+def normalize_query(text: str) -> str:
+    """Case and whitespace insensitive form of a query, ignoring trailing punctuation."""
+    return " ".join(text.casefold().split()).rstrip(" .?!।")
+
+
+def query_fingerprint(context: str, language: str, query: str) -> str:
+    """Identifies the answer to a text query: same context, language and normalized text."""
+    return hashlib.sha1(f"{context}\x1f{language}\x1f{normalize_query(query)}".encode()).hexdigest()
+
+
+class AnswerCache:
+    """
+    Caches backend answers to text queries by (context, language, normalized query).
+
+    Lookups go to a bounded in-process LRU first, evicted by entry count and by total
+    size, then to Redis, which is shared by every worker. Each context has its own TTL
+    and contexts without one are never cached. The Telegram file_id of the answer's
+    voice message is stored with the answer so that a hit resends audio without
+    downloading it again.
+
+    Unless given explicitly, `enabled` and the TTLs follow the current settings, so a
+    configuration reload applies to the next lookup. The LRU bounds are read once.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None, ttls: Optional[dict] = None,
+                 max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        settings = get_settings().answer_cache
+        self._enabled = enabled
+        self._ttls = ttls
+        self.max_entries = settings.local_max_entries if max_entries is None else max_entries
+        self.max_bytes = settings.local_max_bytes if max_bytes is None else max_bytes
+        self.local_bytes = 0
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self._local = OrderedDict()  # key -> (expires_at, size, entry)
+
+    @property
+    def enabled(self) -> bool:
+        return get_settings().answer_cache.enabled if self._enabled is None else self._enabled
+
+    @property
+    def ttls(self) -> dict:
+        return get_settings().answer_cache.context_ttl if self._ttls is None else self._ttls
+
+    def _ttl(self, context: str) -> int:
+        return int(self.ttls.get(context, 0)) if self.enabled else 0
+
+    @staticmethod
+    def _key(context: str, language: str, query: str) -> str:
+        return f"answer_{query_fingerprint(context, language, query)}"
+
+    def _local_get(self, key) -> Optional[dict]:
+        item = self._local.get(key)
+        if item is None:
+            return None
+        expires_at, _, entry = item
+        if expires_at < time.monotonic():
+            self._local_pop(key)
+            return None
+        self._local.move_to_end(key)
+        return entry
+
+    def _local_pop(self, key):
+        item = self._local.pop(key, None)
+        if item is not None:
+            self.local_bytes -= item[1]
+
+    def _local_put(self, key, entry: dict, size: int, ttl: float):
+        self._local_pop(key)
+        self._local[key] = (time.monotonic() + ttl, size, entry)
+        self.local_bytes += size
+        while self._local and (len(self._local) > self.max_entries or self.local_bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self._local.popitem(last=False)
+            self.local_bytes -= evicted_size
+
+    async def get(self, context: str, language: str, query: str) -> Optional[dict]:
+        """Returns the cached response for a query, or None on a miss."""
+        ttl = self._ttl(context)
+        if not ttl or not query:
+            return None
+        key = self._key(context, language, query)
+        entry = self._local_get(key)
+        if entry is not None:
+            self.local_hits += 1
+            return entry
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.ttl(key)
+                payload, remaining = await pipe.execute()
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.error({"category": "answer_cache", "label": "get_failed", "error": str(e)})
+            payload = None
+        if payload is None:
+            self.misses += 1
+            return None
+        self.redis_hits += 1
+        entry = json.loads(payload)
+        self._local_put(key, entry, len(payload), remaining if remaining > 0 else ttl)
+        return entry
+
+    async def _store(self, key: str, entry: dict, ttl: float, keep_ttl=False):
+        payload = json.dumps(entry)
+        self._local_put(key, entry, len(payload), ttl)
+        try:
+            if keep_ttl:
+                await get_redis().set(key, payload, keepttl=True, xx=True)
+            else:
+                await get_redis().set(key, payload, ex=ttl)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.error({"category": "answer_cache", "label": "put_failed", "error": str(e)})
+
+    async def put(self, context: str, language: str, query: str, response: dict):
+        """Caches a successful backend response."""
+        ttl = self._ttl(context)
+        if not ttl or not query or "output" not in response:
+            return
+        await self._store(self._key(context, language, query), {"output": response["output"]}, ttl)
+
+    async def set_voice_file_id(self, context: str, language: str, query: str, file_id: str):
+        """Remembers the Telegram file_id of the voice message sent for a cached answer."""
+        ttl = self._ttl(context)
+        if not ttl or not query:
+            return
+        key = self._key(context, language, query)
+        entry = self._local_get(key)
+        if entry is None:
+            return
+        remaining = self._local[key][0] - time.monotonic()
+        await self._store(key, dict(entry, voice_file_id=file_id), remaining, keep_ttl=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "local_entries": len(self._local),
+            "local_bytes": self.local_bytes,
+        }
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+from typing import Callable, Optional
+
+import httpx
+
+from http_client import backend_total_timeout, get_http_client
+
+backend_streaming = os.getenv('BACKEND_STREAMING', 'false').lower() == 'true'
+
+STREAM_ACCEPT = "text/event-stream, application/json"
+
+
+def _parse_event(data: str):
+    """Returns (text delta, final response) for the data of one server-sent event."""
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return data, None
+    if isinstance(payload, dict):
+        if "output" in payload:
+            return "", payload
+        return str(payload.get("text", "")), None
+    return data, None
+
+
+async def _sse_events(response: httpx.Response):
+    data = []
+    async for line in response.aiter_lines():
+        if not line:
+            if data:
+                yield "\n".join(data)
+                data = []
+        elif line.startswith("data:"):
+            value = line[5:]
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield "\n".join(data)
+
+
+async def _read_answer(url: str, body: dict, headers: dict, on_text: Callable[[str], None]) -> dict:
+    async with get_http_client(url).stream("POST", url, json=body, headers=dict(headers, accept=STREAM_ACCEPT)) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            # The backend does not stream: the usual `output.text` response
+            return json.loads(await response.aread())
+
+        text = ""
+        final = None
+        if content_type.startswith("text/event-stream"):
+            async for data in _sse_events(response):
+                if data == "[DONE]":
+                    break
+                delta, final = _parse_event(data)
+                if final is not None:
+                    break
+                if delta:
+                    text += delta
+                    on_text(text)
+        else:
+            async for chunk in response.aiter_text():
+                if chunk:
+                    text += chunk
+                    on_text(text)
+
+    output = final.get("output") if final is not None else None
+    if not isinstance(output, dict):
+        # No usable final event: the streamed text is the answer
+        output = {}
+    output.setdefault("text", text)
+    output.setdefault("audio", None)
+    return dict(final or {}, output=output)
+
+
+async def stream_answer(url: str, body: dict, headers: dict, on_text: Callable[[str], None],
+                        timeout: Optional[float] = None) -> dict:
+    """
+    POSTs a query asking the backend to stream its answer, calling `on_text` with the text
+    received so far as it arrives, and returns the complete response in the same
+    `{"output": {"text": ..., "audio": ...}}` shape as a non-streamed call.
+
+    The backend may reply with server-sent events, whose data is either a text delta
+    (plain or `{"text": ...}`) or the final `{"output": ...}` response, with a chunked
+    plain text body, or with the usual JSON response if it does not stream at all.
+    `timeout` bounds the whole exchange, defaulting to BACKEND_TOTAL_TIMEOUT.
+    """
+    try:
+        return await asyncio.wait_for(_read_answer(url, dict(body, output=dict(body["output"], stream=True)), headers, on_text),
+                                      timeout if timeout is not None else backend_total_timeout)
+    except asyncio.TimeoutError:
+        raise httpx.TimeoutException(f"Request to {url} exceeded total timeout")
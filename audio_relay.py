@@ -0,0 +1,151 @@
+import asyncio
+import os
+from typing import List, Tuple
+
+import httpx
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+from http_client import get_http_client
+from logger import logger
+from send_scheduler import PRIORITY_ANSWER
+
+audio_relay_chunk_size = int(os.getenv('AUDIO_RELAY_CHUNK_SIZE', str(64 * 1024)))
+audio_relay_max_bytes = int(os.getenv('AUDIO_RELAY_MAX_BYTES', str(20 * 1024 * 1024)))
+audio_relay_max_inflight_bytes = int(os.getenv('AUDIO_RELAY_MAX_INFLIGHT_BYTES', str(64 * 1024 * 1024)))
+audio_relay_timeout = float(os.getenv('AUDIO_RELAY_TIMEOUT', '60'))
+# Audio URLs starting with one of these prefixes are fetched by Telegram itself
+audio_public_url_prefixes = tuple(filter(None, os.getenv('AUDIO_PUBLIC_URL_PREFIXES', '').split(',')))
+
+
+class AudioRelayError(Exception):
+    pass
+
+
+class BudgetExhausted(AudioRelayError):
+    """Raised to the transfer that would otherwise wait for bytes only other waiting transfers hold."""
+
+
+class ByteBudget:
+    """
+    Caps the number of audio bytes held in memory across all concurrent transfers.
+
+    A transfer that already holds bytes and needs more waits for them like any other,
+    unless every transfer holding bytes is waiting too: nothing would ever be released,
+    so that last transfer gets BudgetExhausted instead, gives its bytes back and starts over.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.available = capacity
+        self.holders = 0
+        self._blocked_holders = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size: int, holding=False) -> int:
+        """Reserves `size` bytes. `holding` says the caller already holds some, which it keeps while it waits."""
+        size = min(size, self.capacity)
+        async with self._condition:
+            if holding:
+                self._blocked_holders += 1
+                try:
+                    while self.available < size:
+                        if self._blocked_holders >= self.holders:
+                            raise BudgetExhausted(f"Audio relay budget of {self.capacity} bytes is exhausted")
+                        await self._condition.wait()
+                finally:
+                    self._blocked_holders -= 1
+                    self._condition.notify_all()
+            else:
+                # Transfers already under way come first, or one that was sent back to start
+                # over would take the bytes it just gave back again
+                await self._condition.wait_for(lambda: self.available >= size and not self._blocked_holders)
+                self.holders += 1
+            self.available -= size
+        return size
+
+    async def release(self, size: int):
+        """Gives back every byte a transfer holds."""
+        async with self._condition:
+            self.available += size
+            self.holders -= 1
+            self._condition.notify_all()
+
+
+_budget = None
+
+
+def _get_budget() -> ByteBudget:
+    # Created lazily so the condition binds to the running event loop
+    global _budget
+    if _budget is None:
+        _budget = ByteBudget(audio_relay_max_inflight_bytes)
+    return _budget
+
+
+def is_public_audio_url(audio_url: str) -> bool:
+    return bool(audio_public_url_prefixes) and audio_url.startswith(audio_public_url_prefixes)
+
+
+async def _download(audio_url: str, budget: ByteBudget) -> Tuple[bytes, int]:
+    """Streams the audio into memory, returning it with the number of budget bytes reserved for it."""
+    async with get_http_client(audio_url).stream("GET", audio_url) as response:
+        response.raise_for_status()
+        declared = int(response.headers.get("content-length") or 0)
+        if declared > audio_relay_max_bytes:
+            raise AudioRelayError(f"Audio at {audio_url} is {declared} bytes, limit is {audio_relay_max_bytes}")
+        # Without a Content-Length the budget is reserved chunk by chunk as the audio arrives,
+        # so a short file does not hold the whole per-file limit while it downloads
+        limit = min(declared or audio_relay_max_bytes, budget.capacity)
+        reserved = await budget.acquire(declared or audio_relay_chunk_size)
+        try:
+            chunks: List[bytes] = []
+            received = 0
+            async for chunk in response.aiter_bytes(audio_relay_chunk_size):
+                received += len(chunk)
+                if received > limit:
+                    raise AudioRelayError(f"Audio at {audio_url} exceeds {limit} bytes")
+                if received > reserved:
+                    wanted = min(max(received - reserved, audio_relay_chunk_size), limit - reserved)
+                    reserved += await budget.acquire(wanted, holding=True)
+                chunks.append(chunk)
+        except BaseException:
+            await budget.release(reserved)
+            raise
+    return b"".join(chunks), reserved
+
+
+async def _download_within_budget(audio_url: str, budget: ByteBudget) -> Tuple[bytes, int]:
+    while True:
+        try:
+            return await _download(audio_url, budget)
+        except BudgetExhausted:
+            # Its bytes are back in the budget, so the transfers it was waiting on can finish
+            logger.warning({"category": "audio_relay", "label": "budget_exhausted", "value": audio_url})
+
+
+async def send_audio(bot: Bot, chat_id: int, audio_url: str) -> Message:
+    """
+    Sends the backend TTS audio at `audio_url` as a voice message.
+
+    Publicly reachable URLs are handed to Telegram as is. Everything else is streamed
+    from the backend in chunks, bounded per transfer by AUDIO_RELAY_MAX_BYTES and across
+    transfers by AUDIO_RELAY_MAX_INFLIGHT_BYTES, and then uploaded.
+    """
+    if is_public_audio_url(audio_url):
+        try:
+            return await bot.send_voice(chat_id=chat_id, voice=audio_url, rate_limit_args=PRIORITY_ANSWER)
+        except BadRequest as e:
+            logger.warning({"category": "audio_relay", "label": "url_rejected", "value": audio_url, "error": str(e)})
+
+    budget = _get_budget()
+    try:
+        audio_data, reserved = await asyncio.wait_for(_download_within_budget(audio_url, budget),
+                                                     audio_relay_timeout)
+    except asyncio.TimeoutError:
+        raise httpx.TimeoutException(f"Audio download from {audio_url} exceeded {audio_relay_timeout}s")
+    try:
+        return await bot.send_voice(chat_id=chat_id, voice=audio_data, rate_limit_args=PRIORITY_ANSWER)
+    finally:
+        del audio_data
+        await budget.release(reserved)
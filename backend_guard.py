@@ -0,0 +1,170 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+import httpx
+
+from config_util import get_backend_setting
+from logger import logger
+
+
+class BackendUnavailable(Exception):
+    """Raised instead of queueing when a backend is saturated or its circuit is open."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of calling a backend once the update's deadline has passed."""
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit: grows by about one slot per limit's worth of calls that
+    finish under the latency target, and shrinks by `backoff` on a slow or failed call.
+    `max_limit` is the bulkhead: the most calls this backend may ever hold at once.
+    """
+
+    def __init__(self, initial: float, min_limit: float, max_limit: float, latency_target: float, backoff=0.9):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+
+    def try_acquire(self) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency: float, failed: bool, adjust=True):
+        self.in_flight -= 1
+        if not adjust:
+            return
+        if failed or latency > self.latency_target:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` failures in a row, and lets one probe through every `reset_timeout`."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def abandon(self):
+        """A call that ended without an outcome: let the next caller probe instead."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic() - self.reset_timeout
+
+    def record(self, failed: bool):
+        if not failed:
+            self.state = self.CLOSED
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+def _is_failure(exc: BaseException) -> bool:
+    """
+    Only what says the backend is unhealthy counts: connection errors, timeouts, 5xx and 429.
+    A 4xx is about the request, and a 200 we cannot parse, a call skipped because the
+    update's deadline had passed or one refused by the guard itself say nothing about it.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(exc, httpx.TransportError)
+
+
+class BackendGuard:
+    """Isolates one Sakhi backend: its own adaptive concurrency limit, bulkhead and circuit breaker."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.limiter = AdaptiveLimiter(
+            initial=float(get_backend_setting(name, 'BACKEND_CONCURRENCY_INITIAL', '16')),
+            min_limit=float(get_backend_setting(name, 'BACKEND_CONCURRENCY_MIN', '2')),
+            max_limit=float(get_backend_setting(name, 'BACKEND_CONCURRENCY_MAX', '128')),
+            latency_target=float(get_backend_setting(name, 'BACKEND_LATENCY_TARGET', '30')),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(get_backend_setting(name, 'BACKEND_BREAKER_FAILURES', '5')),
+            reset_timeout=float(get_backend_setting(name, 'BACKEND_BREAKER_RESET_TIMEOUT', '30')),
+        )
+        self.rejected_open = 0
+        self.rejected_saturated = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        """Holds a concurrency slot for one call, raising BackendUnavailable if none can be had right now."""
+        if not self.breaker.allow():
+            self.rejected_open += 1
+            raise BackendUnavailable(f"{self.name} backend circuit is open")
+        if not self.limiter.try_acquire():
+            self.rejected_saturated += 1
+            raise BackendUnavailable(f"{self.name} backend is at its concurrency limit of {int(self.limiter.limit)}")
+        start = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if isinstance(error, (asyncio.CancelledError, DeadlineExceeded)):
+                # The caller went away or never sent the call, which says nothing about the backend
+                self.limiter.release(0, False, adjust=False)
+                self.breaker.abandon()
+            else:
+                self._record(time.monotonic() - start, _is_failure(error))
+
+    def _record(self, latency: float, failed: bool):
+        was_open = self.breaker.state != CircuitBreaker.CLOSED
+        self.limiter.release(latency, failed)
+        self.breaker.record(failed)
+        if was_open != (self.breaker.state != CircuitBreaker.CLOSED):
+            logger.warning({"category": "backend_guard", "label": "breaker_" + self.breaker.state, "value": self.name})
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limiter.limit, 2),
+            "in_flight": self.limiter.in_flight,
+            "breaker": self.breaker.state,
+            "rejected_open": self.rejected_open,
+            "rejected_saturated": self.rejected_saturated,
+        }
+
+
+_guards: Dict[str, BackendGuard] = {}
+
+
+def get_backend_guard(name: str) -> BackendGuard:
+    guard = _guards.get(name)
+    if guard is None:
+        guard = _guards[name] = BackendGuard(name)
+    return guard
+
+
+def backend_guard_stats() -> dict:
+    return {name: guard.stats() for name, guard in _guards.items()}
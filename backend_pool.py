@@ -0,0 +1,146 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from backend_guard import DeadlineExceeded
+from config_util import get_backend_setting
+
+T = TypeVar("T")
+
+# Recent successful call latencies per backend that the hedging delay is taken from
+LATENCY_WINDOW = 200
+# Calls a backend must have answered before its latency quantile is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+
+
+class Replica:
+    __slots__ = ("url", "in_flight", "calls", "failures")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+
+
+class BackendPool:
+    """
+    The replicas of one Sakhi backend, listed comma separated in `<NAME>_API_BASE_URL`.
+
+    Each call goes to the replica with the fewest calls in flight from this worker, picked at
+    random among equals, and must finish by the caller's deadline. With hedging on, a call
+    still running after the backend's recent `hedge_quantile` latency is sent again to the
+    least busy other replica. The first of the two to succeed is used and the other is
+    cancelled; if one fails, the other is still awaited.
+    """
+
+    def __init__(self, name: str, base_urls: List[str], hedging: Optional[bool] = None,
+                 hedge_quantile: Optional[float] = None):
+        if not base_urls:
+            raise ValueError(f"{name.upper()}_API_BASE_URL lists no backend replicas")
+        self.name = name
+        self.replicas = [Replica(url.rstrip('/')) for url in base_urls]
+        self.hedging = (get_backend_setting(name, 'BACKEND_HEDGING', 'false').lower() == 'true'
+                        if hedging is None else hedging)
+        self.hedge_quantile = (float(get_backend_setting(name, 'BACKEND_HEDGE_QUANTILE', '0.95'))
+                               if hedge_quantile is None else hedge_quantile)
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def pick(self, exclude: Optional[Replica] = None) -> Optional[Replica]:
+        candidates = [replica for replica in self.replicas if replica is not exclude]
+        if not candidates:
+            return None
+        fewest = min(replica.in_flight for replica in candidates)
+        return random.choice([replica for replica in candidates if replica.in_flight == fewest])
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging a call, or None while hedging is off or not possible."""
+        if not self.hedging or len(self.replicas) < 2 or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_quantile))]
+
+    async def _attempt(self, replica: Replica, send: Callable[[str, float], Awaitable[T]], deadline: float) -> T:
+        replica.in_flight += 1
+        start = time.monotonic()
+        try:
+            result = await send(replica.url, deadline - start)
+        except asyncio.CancelledError:
+            # A hedge that lost, or a caller that went away
+            raise
+        except Exception:
+            replica.failures += 1
+            raise
+        finally:
+            replica.in_flight -= 1
+            replica.calls += 1
+        self._latencies.append(time.monotonic() - start)
+        return result
+
+    async def call(self, send: Callable[[str, float], Awaitable[T]], deadline: float, hedge=True) -> T:
+        """
+        Calls `send(base_url, timeout)` on a replica, with `timeout` the seconds left until
+        `deadline` (on the `time.monotonic` clock). Calls that can't be repeated, such as
+        streamed answers, pass `hedge=False`.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"No time left to call the {self.name} backend")
+        first = self.pick()
+        delay = self.hedge_delay() if hedge else None
+        if delay is None or delay >= remaining:
+            return await self._attempt(first, send, deadline)
+
+        pending = {asyncio.ensure_future(self._attempt(first, send, deadline))}
+        hedged = None
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self.hedges += 1
+                hedged = asyncio.ensure_future(self._attempt(self.pick(exclude=first), send, deadline))
+                pending.add(hedged)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedged:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "hedging": self.hedging,
+            "hedge_delay": self.hedge_delay(),
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "replicas": {replica.url: {"in_flight": replica.in_flight, "calls": replica.calls,
+                                       "failures": replica.failures} for replica in self.replicas},
+        }
+
+
+_pools: Dict[str, BackendPool] = {}
+
+
+def get_backend_pool(name: str) -> BackendPool:
+    """Returns the pool of backend `name`, built from `<NAME>_API_BASE_URL` on first use."""
+    pool = _pools.get(name)
+    if pool is None:
+        base_urls = [url.strip() for url in os.environ[f"{name.upper()}_API_BASE_URL"].split(",") if url.strip()]
+        pool = _pools[name] = BackendPool(name, base_urls)
+    return pool
+
+
+def backend_pool_stats() -> dict:
+    return {name: pool.stats() for name, pool in _pools.items()}
@@ -0,0 +1,125 @@
+"""
+Local stand-ins for the Telegram Bot API and the Sakhi story/activity backends, used by
+run_benchmark.py. Can also be run on its own to try the bot by hand:
+
+    python benchmark/fake_services.py --port 8090 --story-latency 2 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qsl
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+RECORDED_METHODS = ("sendMessage", "editMessageText", "sendVoice", "editMessageReplyMarkup", "answerCallbackQuery")
+
+
+class CallRecorder:
+    """Counts Bot API calls by method and tells `on_call` about every recorded one."""
+
+    def __init__(self, on_call: Optional[Callable[[str, dict], None]] = None):
+        self.on_call = on_call
+        self.calls = Counter()
+        self.backend_calls = Counter()
+        self.backend_errors = 0
+
+    def record(self, method: str, data: dict):
+        self.calls[method] += 1
+        if self.on_call is not None:
+            self.on_call(method, data)
+
+
+class FakeServices:
+    def __init__(self, recorder: CallRecorder, public_url: str, story_latency=1.0, activity_latency=0.5,
+                 error_rate=0.0, audio_bytes=32 * 1024):
+        self.recorder = recorder
+        self.public_url = public_url
+        self.latency = {"query_rstory": story_latency, "chat": activity_latency}
+        self.error_rate = error_rate
+        self.audio = b"OggS" + bytes(audio_bytes)
+        self._message_ids = itertools.count(1)
+
+    async def bot_api(self, request: Request) -> Response:
+        method = request.path_params["method"]
+        content_type = request.headers.get("content-type", "")
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            data = {key: value for key, value in form.items() if isinstance(value, str)}
+        elif content_type.startswith("application/json"):
+            data = await request.json()
+        else:
+            data = dict(parse_qsl((await request.body()).decode()))
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendVoice", "editMessageReplyMarkup"):
+            chat_id = int(data.get("chat_id", 0))
+            result = {"message_id": int(data.get("message_id") or next(self._message_ids)), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+            if method == "sendVoice":
+                message_id = result["message_id"]
+                result["voice"] = {"file_id": f"voice{message_id}", "file_unique_id": f"unique{message_id}", "duration": 1}
+        elif method == "getFile":
+            file_id = data["file_id"]
+            result = {"file_id": file_id, "file_unique_id": f"unique_{file_id}", "file_path": f"voice/{file_id}.oga"}
+        else:
+            result = True
+        if method in RECORDED_METHODS:
+            self.recorder.record(method, data)
+        return JSONResponse({"ok": True, "result": result})
+
+    async def backend(self, request: Request) -> Response:
+        endpoint = request.path_params["endpoint"]
+        body = await request.json()
+        self.recorder.backend_calls[endpoint] += 1
+        await asyncio.sleep(self.latency.get(endpoint, 0))
+        if random.random() < self.error_rate:
+            self.recorder.backend_errors += 1
+            return JSONResponse({"detail": "benchmark error"}, status_code=500)
+        query = body["input"].get("text") or "voice note"
+        return JSONResponse({"output": {"text": f"Answer to *{query}*: " + "lorem ipsum dolor sit amet " * 20,
+                                        "audio": f"{self.public_url}/audio/answer.ogg"}})
+
+    async def telemetry(self, request: Request) -> Response:
+        await request.body()
+        return JSONResponse({"status": "ok"})
+
+    async def audio_file(self, request: Request) -> Response:
+        return Response(self.audio, media_type="audio/ogg")
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[
+            Route("/bot{token}/{method}", self.bot_api, methods=["GET", "POST"]),
+            Route("/v1/telemetry", self.telemetry, methods=["POST"]),
+            Route("/v1/{endpoint}", self.backend, methods=["POST"]),
+            Route("/audio/{name}", self.audio_file, methods=["GET"]),
+        ])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--story-latency", type=float, default=1.0, help="seconds the story backend takes to answer")
+    parser.add_argument("--activity-latency", type=float, default=0.5, help="seconds the activity backend takes to answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of backend calls answered with a 500")
+    args = parser.parse_args()
+
+    def log_call(method: str, data: Dict):
+        print(method, json.dumps(data)[:200], flush=True)
+
+    services = FakeServices(CallRecorder(log_call), f"http://127.0.0.1:{args.port}", args.story_latency,
+                            args.activity_latency, args.error_rate)
+    uvicorn.run(services.app(), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+End-to-end load benchmark for telegram_webhook.py.
+
+Starts a fakeredis server (unless --redis is given), the Bot API and backend stand-ins
+from fake_services.py and the webhook itself, then POSTs synthetic text, voice and
+callback query updates at a fixed rate. An update counts as done when the bot makes its
+last Bot API call for it. Reports the throughput, end-to-end latency percentiles and the
+peak RSS of the webhook processes:
+
+    python benchmark/run_benchmark.py --rate 50 --updates 2000 --workers 2
+
+Any environment variable of the bot can be exported beforehand to benchmark a setting.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+
+from fake_services import CallRecorder, FakeServices
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_URL = "http://127.0.0.1:8000"
+SECRET_TOKEN = "benchmark"
+FIRST_CHAT_ID = 10_000_000
+
+
+class PendingUpdate:
+    def __init__(self, kind: str, sent_at: float):
+        self.kind = kind
+        self.sent_at = sent_at
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class LoadGenerator:
+    """Builds synthetic updates, one chat per update, and matches Bot API calls back to them."""
+
+    def __init__(self, mix: Dict[str, float], distinct_queries: int):
+        self.mix = mix
+        self.distinct_queries = distinct_queries
+        # update_ids differ between runs, so that a persistent Redis does not drop them as redeliveries
+        self.first_update_id = int(time.time() * 1000)
+        self.pending: Dict[int, PendingUpdate] = {}
+        self.latencies: List[float] = []
+        self.outcomes = Counter()
+        self.last_done_at = 0.0
+
+    def build_update(self, index: int, kind: str) -> dict:
+        chat_id = FIRST_CHAT_ID + index
+        user = {"id": chat_id, "is_bot": False, "first_name": "bench"}
+        chat = {"id": chat_id, "type": "private", "first_name": "bench"}
+        message = {"message_id": index + 1, "date": int(time.time()), "chat": chat, "from": user}
+        variant = index % self.distinct_queries if self.distinct_queries else index
+        if kind == "text":
+            message["text"] = f"benchmark question {variant}"
+        elif kind == "voice":
+            message["voice"] = {"file_id": f"voice{variant}", "file_unique_id": f"unique{variant}", "duration": 3}
+        else:
+            return {"update_id": self.first_update_id + index, "callback_query": {
+                "id": str(index), "chat_instance": str(chat_id), "data": f"message-liked__{index + 1}", "from": user,
+                "message": {"message_id": index + 1, "date": int(time.time()), "chat": chat, "text": "answer"}}}
+        return {"update_id": self.first_update_id + index, "message": message}
+
+    def on_call(self, method: str, data: dict):
+        try:
+            chat_id = int(data.get("chat_id", 0))
+        except ValueError:
+            return
+        update = self.pending.get(chat_id)
+        if update is None or update.done.done():
+            return
+        is_error_reply = method == "editMessageText" and "parse_mode" not in data
+        if update.kind == "text":
+            done = method == "editMessageText" and ("reply_markup" in data or is_error_reply)
+        elif update.kind == "voice":
+            done = method == "sendVoice" or is_error_reply
+        else:
+            done = method == "editMessageReplyMarkup"
+        if done:
+            self.finish(chat_id, "error_reply" if is_error_reply else "answered")
+
+    def finish(self, chat_id: int, outcome: str):
+        update = self.pending.pop(chat_id)
+        now = time.monotonic()
+        update.done.set_result(outcome)
+        self.outcomes[outcome] += 1
+        if outcome in ("answered", "error_reply"):
+            self.latencies.append(now - update.sent_at)
+            self.last_done_at = now
+
+    async def send(self, client: httpx.AsyncClient, index: int, kind: str):
+        chat_id = FIRST_CHAT_ID + index
+        self.pending[chat_id] = PendingUpdate(kind, time.monotonic())
+        try:
+            response = await client.post(f"{WEBHOOK_URL}/telegram", json=self.build_update(index, kind),
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN})
+        except httpx.HTTPError:
+            self.finish(chat_id, "post_failed")
+            return
+        if response.status_code != 200 and chat_id in self.pending:
+            self.finish(chat_id, "shed" if response.status_code == 503 else f"http_{response.status_code}")
+
+    async def run(self, rate: float, updates: int, drain_timeout: float) -> float:
+        kinds, weights = zip(*self.mix.items())
+        limits = httpx.Limits(max_connections=1000, max_keepalive_connections=1000)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            started_at = time.monotonic()
+            tasks = []
+            for index in range(updates):
+                delay = started_at + index / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                kind = random.choices(kinds, weights)[0]
+                tasks.append(asyncio.create_task(self.send(client, index, kind)))
+            await asyncio.gather(*tasks)
+            waiting = [update.done for update in self.pending.values()]
+            if waiting:
+                await asyncio.wait(waiting, timeout=drain_timeout)
+        for chat_id in list(self.pending):
+            self.finish(chat_id, "timed_out")
+        return started_at
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile, rounded to the tenth of a millisecond."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(0, math.ceil(fraction * len(ordered)) - 1)], 4)
+
+
+def process_tree(pid: int) -> List[int]:
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    parents[int(entry)] = int(stat.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree = [pid]
+    for current in tree:
+        tree.extend(child for child, parent in parents.items() if parent == current)
+    return tree
+
+
+def peak_rss_kb(pid: int) -> Dict[int, int]:
+    """VmHWM, the peak resident set size, of `pid` and each of its descendants."""
+    peaks = {}
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        peaks[process] = int(line.split()[1])
+        except OSError:
+            continue
+    return peaks
+
+
+def start_fake_redis(port: int):
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def wait_until_healthy(process: asyncio.subprocess.Process, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.returncode is not None:
+                raise RuntimeError(f"telegram_webhook.py exited with {process.returncode}, see the webhook log")
+            try:
+                if (await client.get(f"{WEBHOOK_URL}/healthcheck")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError("telegram_webhook.py did not become healthy, see the webhook log")
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in ("text", "voice", "callback"):
+            raise argparse.ArgumentTypeError(f"unknown update kind {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+async def benchmark(args) -> dict:
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    generator = LoadGenerator(args.mix, args.distinct_queries)
+    recorder = CallRecorder(generator.on_call)
+    services = FakeServices(recorder, fake_url, args.story_latency, args.activity_latency, args.error_rate)
+    fake_server = uvicorn.Server(uvicorn.Config(services.app(), host="127.0.0.1", port=args.fake_port,
+                                                log_level="warning"))
+    fake_task = asyncio.create_task(fake_server.serve())
+
+    redis_server = None
+    if args.redis:
+        redis_host, _, redis_port = args.redis.partition(":")
+    else:
+        redis_host, redis_port = "127.0.0.1", str(args.fake_redis_port)
+        redis_server = start_fake_redis(args.fake_redis_port)
+
+    env = dict(os.environ)
+    for name, value in {
+        "TELEGRAM_BOT_TOKEN": "123456:benchmark", "TELEGRAM_BOT_NAME": "benchmark", "LOG_LEVEL": "WARNING",
+        "TELEGRAM_BASE_URL": WEBHOOK_URL, "TELEGRAM_API_BASE_URL": fake_url, "TELEGRAM_WEBHOOK_SECRET_TOKEN": SECRET_TOKEN,
+        "STORY_API_BASE_URL": fake_url, "ACTIVITY_API_BASE_URL": fake_url, "TELEMETRY_ENDPOINT_URL": fake_url,
+        "SUPPORTED_LANGUAGES": "en", "UVICORN_WORKERS": str(args.workers),
+        # Telegram's flood limits are not what is being measured, unless exported on purpose
+        "SEND_GLOBAL_RATE": "100000", "SEND_GLOBAL_BURST": "100000", "SEND_CHAT_RATE": "100", "SEND_CHAT_BURST": "10",
+    }.items():
+        env.setdefault(name, value)
+    env["REDIS_HOST"], env["REDIS_PORT"] = redis_host, redis_port
+
+    with open(args.webhook_log, "w") as log:
+        webhook = await asyncio.create_subprocess_exec(sys.executable, "telegram_webhook.py", cwd=REPO_DIR, env=env,
+                                                       stdout=log, stderr=log)
+    try:
+        await wait_until_healthy(webhook, args.startup_timeout)
+        started_at = await generator.run(args.rate, args.updates, args.drain_timeout)
+        peaks = peak_rss_kb(webhook.pid)
+    finally:
+        if webhook.returncode is None:
+            webhook.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(webhook.wait(), 30)
+            except asyncio.TimeoutError:
+                webhook.kill()
+        fake_server.should_exit = True
+        await fake_task
+        if redis_server is not None:
+            redis_server.shutdown()
+
+    latencies = generator.latencies
+    elapsed = (generator.last_done_at or time.monotonic()) - started_at
+    completed = len(latencies)
+    return {
+        "offered_rate": args.rate,
+        "updates_sent": args.updates,
+        "outcomes": dict(generator.outcomes),
+        "updates_per_second": round(completed / elapsed, 2) if elapsed > 0 else None,
+        "latency_seconds": {name: percentile(latencies, fraction) for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+        "bot_api_calls": dict(recorder.calls),
+        "bot_api_calls_per_update": round(sum(recorder.calls.values()) / completed, 2) if completed else None,
+        "backend_calls": dict(recorder.backend_calls),
+        "backend_errors": recorder.backend_errors,
+        "peak_rss_mb": {"total": round(sum(peaks.values()) / 1024, 1),
+                        "largest_process": round(max(peaks.values(), default=0) / 1024, 1)},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=20, help="updates posted per second")
+    parser.add_argument("--updates", type=int, default=500, help="updates posted in total")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=0.7,voice=0.2,callback=0.1"),
+                        help="relative weights of text, voice and callback updates")
+    parser.add_argument("--distinct-queries", type=int, default=0,
+                        help="cycle through this many distinct queries and voice notes, 0 makes every one unique")
+    parser.add_argument("--workers", type=int, default=1, help="UVICORN_WORKERS of the webhook")
+    parser.add_argument("--story-latency", type=float, default=1.0)
+    parser.add_argument("--activity-latency", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of backend calls answered with a 500")
+    parser.add_argument("--redis", help="HOST:PORT of a Redis to use instead of starting fakeredis")
+    parser.add_argument("--fake-redis-port", type=int, default=16379)
+    parser.add_argument("--fake-port", type=int, default=8090, help="port of the Bot API and backend stand-ins")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--drain-timeout", type=float, default=60,
+                        help="seconds to wait for outstanding updates after the last one is posted")
+    parser.add_argument("--webhook-log", default=os.path.join(REPO_DIR, "benchmark", "benchmark_webhook.log"),
+                        help="file the webhook's output is written to")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    latency = results["latency_seconds"]
+    print(f"updates sent        {results['updates_sent']} at {results['offered_rate']}/s")
+    print(f"outcomes            {results['outcomes']}")
+    print(f"throughput          {results['updates_per_second']} updates/s")
+    print(f"latency (s)         p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    print(f"bot api calls       {results['bot_api_calls']} ({results['bot_api_calls_per_update']} per update)")
+    print(f"backend calls       {results['backend_calls']}, {results['backend_errors']} errors")
+    print(f"peak rss (MB)       {results['peak_rss_mb']['total']} total, "
+          f"{results['peak_rss_mb']['largest_process']} largest process")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import sys
+import uuid
+from typing import Any, Awaitable, Dict, Optional, Set
+
+from redis.exceptions import RedisError
+from telegram.ext import BaseUpdateProcessor
+
+from logger import logger
+from redis_util import get_redis
+
+# Updates of one chat waiting or running before more from that chat are dropped
+chat_lane_max_pending = int(os.getenv('CHAT_LANE_MAX_PENDING', '10'))
+# Seconds the cross-worker lock of a chat is held at most; keep above UPDATE_DEADLINE
+chat_lane_lock_ttl = float(os.getenv('CHAT_LANE_LOCK_TTL', '120'))
+# Bounds of the backoff between attempts to take a chat lock another worker holds
+CHAT_LOCK_POLL_MIN = 0.01
+CHAT_LOCK_POLL_MAX = 0.2
+
+_REDIS_ERRORS = (RedisError, OSError, asyncio.TimeoutError)
+
+# Deletes the lock only while it still holds this update's token, not one taken after it expired
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class _Lane:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class ChatLaneUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs the updates of each chat one at a time, in the order they arrived, and the updates
+    of different chats in parallel, up to `max_concurrent_updates` at once.
+
+    Every chat with updates outstanding has its own lane, created on its first update and
+    removed once it is idle. Only the update at the head of a lane takes one of the shared
+    slots, so a chat sending many messages holds a single slot and queues behind other
+    chats for it. A chat with `max_pending_per_chat` updates outstanding gets further
+    updates dropped. Updates without a chat run without a lane.
+
+    Lanes only order updates within one worker. With `shared` set, as when uvicorn runs
+    several workers, the head of a lane also takes a Redis lock on its chat under
+    `namespace` before it takes a slot, so no two workers handle updates of one chat at
+    once. Workers take the lock in whatever order they poll for it, so updates of a chat
+    that reach different workers are not handled one at a time in arrival order. A lock
+    is held for at most `lock_ttl` seconds; an update that waits that long, or cannot reach
+    Redis, runs without it.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_per_chat=chat_lane_max_pending,
+                 namespace: str = "", shared=False, lock_ttl=chat_lane_lock_ttl):
+        # PTB's own semaphore is taken before do_process_update, while an update may still wait
+        # for its lane, so it must not limit anything: the slots below do.
+        super().__init__(max_concurrent_updates=sys.maxsize)
+        self.concurrency = max_concurrent_updates
+        self.max_pending_per_chat = max_pending_per_chat
+        self.namespace = namespace
+        self.shared = shared
+        self.lock_ttl = lock_ttl
+        self.dropped = 0
+        self.lock_waits = 0
+        self.lock_timeouts = 0
+        self.lock_errors = 0
+        self._origin = uuid.uuid4().hex
+        self._lock_count = 0
+        self.running = 0
+        self._lanes: Dict[int, _Lane] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._slots = None
+
+    async def initialize(self) -> None:
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _run(self, coroutine: Awaitable[Any]):
+        async with self._slots:
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._tasks.discard(task)
+
+    async def _process(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await self._run(coroutine)
+            return
+        lane = self._lanes.get(chat.id)
+        if lane is None:
+            lane = self._lanes[chat.id] = _Lane()
+        if lane.pending >= self.max_pending_per_chat:
+            self.dropped += 1
+            coroutine.close()
+            if self.dropped % 100 == 1:
+                logger.warning({"category": "chat_lanes", "label": "dropped", "id": chat.id, "dropped": self.dropped})
+            return
+        lane.pending += 1
+        try:
+            # asyncio.Lock wakes its waiters first come, first served
+            async with lane.lock:
+                token = await self._lock_chat(chat.id) if self.shared else None
+                try:
+                    await self._run(coroutine)
+                finally:
+                    if token is not None:
+                        await self._unlock_chat(chat.id, token)
+        finally:
+            lane.pending -= 1
+            if not lane.pending:
+                del self._lanes[chat.id]
+
+    async def _lock_chat(self, chat_id: int) -> Optional[str]:
+        """Takes the Redis lock of a chat, and returns its token, or None to run without it."""
+        self._lock_count += 1
+        token = f"{self._origin}:{self._lock_count}"
+        key = f"{self.namespace}_chat_lock_{chat_id}"
+        redis = get_redis()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_ttl
+        poll = CHAT_LOCK_POLL_MIN
+        try:
+            while True:
+                if await redis.set(key, token, nx=True, px=int(self.lock_ttl * 1000)):
+                    return token
+                if poll == CHAT_LOCK_POLL_MIN:
+                    self.lock_waits += 1
+                if loop.time() >= deadline:
+                    self.lock_timeouts += 1
+                    logger.warning({"category": "chat_lanes", "label": "lock_wait_timeout", "id": chat_id})
+                    return None
+                await asyncio.sleep(poll)
+                poll = min(poll * 2, CHAT_LOCK_POLL_MAX)
+        except _REDIS_ERRORS as e:
+            self.lock_errors += 1
+            if self.lock_errors % 100 == 1:
+                logger.error({"category": "chat_lanes", "label": "lock_failed", "error": str(e),
+                              "errors": self.lock_errors})
+            return None
+
+    async def _unlock_chat(self, chat_id: int, token: str):
+        try:
+            await get_redis().eval(_RELEASE_SCRIPT, 1, f"{self.namespace}_chat_lock_{chat_id}", token)
+        except _REDIS_ERRORS as e:
+            # The lock expires on its own after lock_ttl
+            logger.error({"category": "chat_lanes", "label": "unlock_failed", "id": chat_id, "error": str(e)})
+
+    def cancel_all(self) -> int:
+        """Cancels every update still running or waiting for its lane, and returns how many there were."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "chats": len(self._lanes),
+            "pending": sum(lane.pending for lane in self._lanes.values()),
+            "dropped": self.dropped,
+            "shared": self.shared,
+            "lock_waits": self.lock_waits,
+            "lock_timeouts": self.lock_timeouts,
+            "lock_errors": self.lock_errors,
+        }
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import signal
+import uuid
+
+from config_util import Settings, load_settings, set_settings
+from language_util import language_init
+from logger import logger
+from redis_util import get_redis
+
+config_reload_channel = os.getenv('CONFIG_RELOAD_CHANNEL', 'sakhi_config_reload')
+
+
+def reload_config() -> Settings:
+    """
+    Reads config.ini again and swaps in the new settings and language catalog.
+    A file that does not validate, or cannot be read, raises ValueError and leaves the running
+    settings as they were.
+    """
+    try:
+        settings = load_settings()
+        # The catalog is built before the settings are swapped, so a failure changes neither
+        language_init(settings)
+    except OSError as e:
+        # A language pack that cannot be opened, or went away between the listing and the read
+        raise ValueError(f"Cannot read the configuration: {e}")
+    set_settings(settings)
+    logger.info({"category": "config_reload", "label": "reloaded", "pid": os.getpid()})
+    return settings
+
+
+class ConfigReloader:
+    """
+    Reloads the configuration of every worker process, on SIGHUP or on request.
+
+    A worker that reloads announces it on a pub/sub channel and the other workers
+    reload too. Reading and validating the file happens off the event loop.
+    """
+
+    def __init__(self, namespace: str, channel=config_reload_channel):
+        self.channel = f"{namespace}_{channel}"
+        self._origin = uuid.uuid4().hex
+        self._listener_task = None
+        self._signal_installed = False
+
+    async def reload(self, broadcast=True) -> Settings:
+        """Reloads this worker, then tells the others to. Raises ValueError if the file is invalid."""
+        settings = await asyncio.get_running_loop().run_in_executor(None, reload_config)
+        if broadcast:
+            try:
+                await get_redis().publish(self.channel, self._origin)
+            except Exception as e:
+                logger.error({"category": "config_reload", "label": "broadcast_failed", "error": str(e)})
+        return settings
+
+    async def _reload_logged(self, broadcast: bool):
+        try:
+            await self.reload(broadcast)
+        except ValueError as e:
+            logger.error({"category": "config_reload", "label": "invalid_config", "error": str(e)})
+
+    def _on_sighup(self):
+        asyncio.create_task(self._reload_logged(broadcast=True))
+
+    async def _listen(self):
+        while True:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None:
+                        continue
+                    if message["data"].decode('utf-8') != self._origin:
+                        await self._reload_logged(broadcast=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A reload we may have missed is picked up by the next one, or by sending SIGHUP to this worker
+                logger.error({"category": "config_reload", "label": "reload_listener", "error": str(e)})
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def start(self):
+        """Installs the SIGHUP handler and starts listening for reloads of other workers."""
+        if self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen())
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._on_sighup)
+            self._signal_installed = True
+        except (NotImplementedError, RuntimeError, ValueError):
+            # No signal handlers off the main thread, or on Windows; the admin endpoint still works
+            pass
+
+    async def stop(self):
+        if self._signal_installed:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            self._signal_installed = False
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            await asyncio.gather(self._listener_task, return_exceptions=True)
+            self._listener_task = None
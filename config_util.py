@@ -1,5 +1,8 @@
+import json
 import os
 from configparser import ConfigParser
+from types import MappingProxyType
+from typing import Iterable, Mapping, NamedTuple, Optional, Tuple
 from logger import logger
 
 config_file_path = 'config.ini'  # Update with your config file path
@@ -7,7 +10,7 @@ config = ConfigParser()
 config.read(config_file_path)
 
 
-def get_config_value(section, key, default=None):
+def _lookup(parser: ConfigParser, section, key, default=None):
     # Check if the key exists in the environment variables
     value = os.getenv(key, default)
 
@@ -15,10 +18,158 @@ def get_config_value(section, key, default=None):
     if value is None or value == "":
         # Attempt to read the config file
         try:
-            value = config.get(section, key, fallback=default)
+            value = parser.get(section, key, fallback=default)
         except Exception as e:
             logger.error(
                 {"Exception": f"Error reading config file: {e}"})
             raise ValueError(f"Missing configuration variable '{key}' in section '{section}'")
 
     return value
+
+
+def get_config_value(section, key, default=None):
+    return _lookup(config, section, key, default)
+
+
+# Preference storage packs a catalog index, plus one, into a byte
+MAX_CATALOG_INDEX = 254
+
+
+def check_catalog_indexes(entries: Iterable[Mapping], key: str):
+    """
+    Raises ValueError unless each `entries` item has an integer `index` from 0 to
+    MAX_CATALOG_INDEX, and `key` and `index` map one to one. An entry may be repeated.
+    """
+    indexes = {}  # key -> index
+    keys = {}  # index -> key
+    for entry in entries:
+        code, index = entry.get(key), entry.get("index")
+        if code is None:
+            raise ValueError(f"an entry has no {key}")
+        if isinstance(index, bool) or not isinstance(index, int) or not 0 <= index <= MAX_CATALOG_INDEX:
+            raise ValueError(f"{key} '{code}' needs an integer index from 0 to {MAX_CATALOG_INDEX}, not {index!r}")
+        if indexes.setdefault(code, index) != index:
+            raise ValueError(f"{key} '{code}' has both index {indexes[code]} and {index}")
+        if keys.setdefault(index, code) != code:
+            raise ValueError(f"index {index} is used by both '{keys[index]}' and '{code}'")
+
+
+def get_backend_setting(backend: str, name: str, default: str) -> str:
+    """Reads `<BACKEND>_<NAME>`, then `<NAME>`, so one backend can be tuned on its own."""
+    return os.getenv(f"{backend.upper()}_{name}", os.getenv(name, default))
+
+
+class DefaultSettings(NamedTuple):
+    context: str
+    language: str
+    welcome_msg: str
+    languages: Tuple[Mapping, ...]
+
+
+class TelemetrySettings(NamedTuple):
+    log_enabled: bool
+    endpoint_url: Optional[str]
+    environment: Optional[str]
+    service_id: str
+    service_ver: str
+    actor_id: str
+    channel: str
+    pdata_id: str
+    events_threshold: int
+    flush_interval: float
+    queue_size: int
+    max_retries: int
+    retry_backoff: float
+
+
+class AnswerCacheSettings(NamedTuple):
+    enabled: bool
+    context_ttl: Mapping[str, int]
+    local_max_entries: int
+    local_max_bytes: int
+
+
+class Settings(NamedTuple):
+    """config.ini, with environment overrides, parsed and validated once."""
+    default: DefaultSettings
+    telemetry: TelemetrySettings
+    answer_cache: AnswerCacheSettings
+
+
+def load_settings(path=config_file_path) -> Settings:
+    """Reads and validates a config file, raising ValueError naming the first bad or missing value."""
+    parser = ConfigParser()
+    if not parser.read(path):
+        raise ValueError(f"Cannot read config file '{path}'")
+
+    def value(section, key, convert=str, required=True):
+        raw = _lookup(parser, section, key)
+        if raw is None or not raw.strip():
+            if not required:
+                return None
+            raise ValueError(f"Missing configuration variable '{key}' in section '{section}'")
+        try:
+            return convert(raw)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ValueError(f"Invalid configuration variable '{key}' in section '{section}': {e}")
+
+    def flag(raw: str) -> bool:
+        return raw.lower() == "true"
+
+    def languages(raw: str) -> Tuple[Mapping, ...]:
+        parsed = json.loads(raw)
+        if not isinstance(parsed, list) or not all(isinstance(item, dict) and {"text", "code", "index"} <= set(item)
+                                                   for item in parsed):
+            raise ValueError("expected a list of objects with text, code and index")
+        check_catalog_indexes(parsed, "code")
+        return tuple(MappingProxyType(item) for item in parsed)
+
+    def ttls(raw: str) -> Mapping[str, int]:
+        return MappingProxyType({context: int(ttl) for context, ttl in json.loads(raw).items()})
+
+
+    return Settings(
+        default=DefaultSettings(
+            context=value('default', 'context'),
+            language=value('default', 'language'),
+            welcome_msg=value('default', 'welcome_msg'),
+            languages=value('default', 'languages', languages),
+        ),
+        telemetry=TelemetrySettings(
+            log_enabled=value('telemetry', 'TELEMETRY_LOG_ENABLED', flag),
+            endpoint_url=value('telemetry', 'TELEMETRY_ENDPOINT_URL', required=False),
+            environment=value('telemetry', 'SERVICE_ENVIRONMENT', required=False),
+            service_id=value('telemetry', 'service_id'),
+            service_ver=value('telemetry', 'service_ver'),
+            actor_id=value('telemetry', 'actor_id'),
+            channel=value('telemetry', 'channel'),
+            pdata_id=value('telemetry', 'pdata_id'),
+            events_threshold=value('telemetry', 'events_threshold', int),
+            flush_interval=value('telemetry', 'flush_interval', float),
+            queue_size=value('telemetry', 'queue_size', int),
+            max_retries=value('telemetry', 'max_retries', int),
+            retry_backoff=value('telemetry', 'retry_backoff', float),
+        ),
+        answer_cache=AnswerCacheSettings(
+            enabled=value('answer_cache', 'ANSWER_CACHE_ENABLED', flag),
+            context_ttl=value('answer_cache', 'context_ttl', ttls),
+            local_max_entries=value('answer_cache', 'local_max_entries', int),
+            local_max_bytes=value('answer_cache', 'local_max_bytes', int),
+        ),
+    )
+
+
+_settings = load_settings()
+
+
+def get_settings() -> Settings:
+    """Returns the current settings snapshot. Hold on to it for the length of one operation, not longer."""
+    return _settings
+
+
+def set_settings(settings: Settings):
+    """Swaps in a new snapshot; readers see either the old one or the new one, never a mix."""
+    global _settings, config
+    parser = ConfigParser()
+    parser.read(config_file_path)
+    _settings, config = settings, parser
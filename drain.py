@@ -0,0 +1,128 @@
+import asyncio
+import os
+import socket
+from typing import Optional, Union
+
+from telegram.ext import Application
+
+from logger import logger
+from redis_util import get_redis
+from update_poller import UpdatePoller
+from webhook_ingestion import UpdateIngestor
+
+# Seconds a stopping worker waits for the updates it accepted before cancelling what is left
+drain_timeout = float(os.getenv('DRAIN_TIMEOUT', '100'))
+drain_channel = os.getenv('DRAIN_CHANNEL', 'sakhi_drain')
+# Seconds between backlog checks while waiting for a drain to finish
+DRAIN_POLL = 0.1
+
+
+def node_id() -> str:
+    """Identifies the workers of one uvicorn supervisor, which share a host and a parent process."""
+    return f"{socket.gethostname()}:{os.getppid()}"
+
+
+class DrainController:
+    """
+    Takes a worker out of rotation without losing the updates it already accepted.
+
+    Draining stops taking new updates: webhook posts get a 503 with Retry-After, so Telegram
+    delivers them again once a running worker answers, and the poller stops after
+    confirming the updates it fetched. /ready reports the worker as not ready from then on.
+    A drain requested from one worker is announced on a pub/sub channel and picked up by the
+    other workers of the same node, so the whole instance leaves rotation at once.
+
+    On shutdown the worker drains, waits up to `timeout` seconds for the backlog to reach
+    zero, and only then cancels what is still running.
+    """
+
+    def __init__(self, application: Application, ingestor: Union[UpdateIngestor, UpdatePoller], namespace: str,
+                 timeout=drain_timeout, channel=drain_channel):
+        self.application = application
+        self.ingestor = ingestor
+        self.timeout = timeout
+        self.channel = f"{namespace}_{channel}"
+        self.node = node_id()
+        self.draining = False
+        self.cancelled = 0
+        self._listener_task = None
+
+    @property
+    def backlog(self) -> int:
+        return self.application.update_queue.backlog
+
+    async def drain(self, broadcast=True):
+        """Stops taking updates in this worker and, with `broadcast`, in the other workers of this node."""
+        if not self.draining:
+            self.draining = True
+            logger.info({"category": "drain", "label": "draining", "pid": os.getpid(), "backlog": self.backlog})
+            if isinstance(self.ingestor, UpdatePoller):
+                await self.ingestor.stop()
+            else:
+                self.ingestor.draining = True
+        if broadcast:
+            try:
+                await get_redis().publish(self.channel, self.node)
+            except Exception as e:
+                logger.error({"category": "drain", "label": "broadcast_failed", "error": str(e)})
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every accepted update is handled. Returns False if `timeout` passed first."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.backlog > 0:
+            if deadline is not None and loop.time() >= deadline:
+                return False
+            await asyncio.sleep(DRAIN_POLL)
+        return True
+
+    async def shutdown(self):
+        """Drains this worker and waits for it, cancelling the updates still running at the deadline."""
+        await self.drain(broadcast=False)
+        started = asyncio.get_running_loop().time()
+        if await self.wait(self.timeout):
+            logger.info({"category": "drain", "label": "drained", "pid": os.getpid(),
+                         "seconds": round(asyncio.get_running_loop().time() - started, 1)})
+            return
+        self.cancelled = self.application.update_processor.cancel_all()
+        logger.warning({"category": "drain", "label": "deadline_passed", "pid": os.getpid(),
+                        "backlog": self.backlog, "cancelled": self.cancelled})
+
+    async def _listen(self):
+        while True:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None:
+                        continue
+                    if message["data"].decode('utf-8') == self.node:
+                        await self.drain(broadcast=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A missed drain is still done by this worker's own shutdown
+                logger.error({"category": "drain", "label": "drain_listener", "error": str(e)})
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def start(self):
+        """Starts listening for drains requested through the other workers of this node."""
+        if self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            await asyncio.gather(self._listener_task, return_exceptions=True)
+            self._listener_task = None
+
+    def stats(self) -> dict:
+        return {
+            "draining": self.draining,
+            "backlog": self.backlog,
+            "timeout": self.timeout,
+            "cancelled": self.cancelled,
+        }
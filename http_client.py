@@ -0,0 +1,59 @@
+import asyncio
+import os
+from typing import Dict
+from urllib.parse import urlsplit
+
+import httpx
+
+from logger import logger
+
+backend_connect_timeout = float(os.getenv('BACKEND_CONNECT_TIMEOUT', '5'))
+backend_read_timeout = float(os.getenv('BACKEND_READ_TIMEOUT', '60'))
+backend_total_timeout = float(os.getenv('BACKEND_TOTAL_TIMEOUT', '90'))
+backend_max_connections = int(os.getenv('BACKEND_MAX_CONNECTIONS', '256'))
+backend_max_keepalive = int(os.getenv('BACKEND_MAX_KEEPALIVE_CONNECTIONS', '64'))
+backend_keepalive_expiry = float(os.getenv('BACKEND_KEEPALIVE_EXPIRY', '30'))
+
+# One long-lived client (and so one keep-alive connection pool) per backend host
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_http_client(url: str) -> httpx.AsyncClient:
+    """Returns the shared async client for the host of `url`, creating it on first use."""
+    origin = _origin(url)
+    client = _clients.get(origin)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(backend_read_timeout, connect=backend_connect_timeout),
+            limits=httpx.Limits(max_connections=backend_max_connections,
+                                max_keepalive_connections=backend_max_keepalive,
+                                keepalive_expiry=backend_keepalive_expiry),
+        )
+        _clients[origin] = client
+        logger.info({"category": "http_client", "label": "pool_created", "value": origin})
+    return client
+
+
+async def post_json(url: str, body: dict, headers: dict = None, timeout: float = None) -> httpx.Response:
+    """
+    POSTs `body` as JSON on the pooled client of the target host.
+    `timeout` bounds the whole exchange (connect + send + read), defaulting to BACKEND_TOTAL_TIMEOUT.
+    """
+    client = get_http_client(url)
+    try:
+        return await asyncio.wait_for(client.post(url, json=body, headers=headers),
+                                      timeout if timeout is not None else backend_total_timeout)
+    except asyncio.TimeoutError:
+        raise httpx.TimeoutException(f"Request to {url} exceeded total timeout")
+
+
+async def close_http_clients() -> None:
+    """Closes every pooled client. Called once on application shutdown."""
+    clients = list(_clients.values())
+    _clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
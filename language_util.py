@@ -1,44 +1,145 @@
 import glob
 import json
+from types import MappingProxyType
+from typing import Dict, NamedTuple, Optional, Tuple
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from logger import logger
-from config_util import get_config_value
+from config_util import Settings, check_catalog_indexes, get_settings
 import os
 
 language_dict = {}
-default_lang = get_config_value('default', 'language', None)
+default_lang = get_settings().default.language
 languages_array = []
 
-def language_init():
-    """Loads language JSON files and builds the language dictionary."""
 
+class LanguageCatalog(NamedTuple):
+    """Everything derived from the language packs, built once by `language_init`."""
+    # (language, key, bot_id) -> frozen message, with fallbacks to default_lang already applied
+    messages: Dict[Tuple[str, str, Optional[str]], object]
+    languages: Tuple[MappingProxyType, ...]
+    language_keyboard: Optional[InlineKeyboardMarkup]
+    context_keyboards: Dict[str, InlineKeyboardMarkup]
+    default_language: str
+
+
+_catalog = LanguageCatalog({}, (), None, {}, default_lang)
+
+
+def _freeze(value):
+    """Returns a read-only copy of a parsed JSON value."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _compile_messages(packs: dict, default_language: str) -> dict:
+    """Resolves every (language, key, bot_id) lookup once, falling back to the default language."""
+    default_pack = packs.get(default_language, {})
+    messages = {}
+    for lang_code, pack in packs.items():
+        for key in set(pack) | set(default_pack):
+            message = pack.get(key) or default_pack.get(key)
+            if message is None:
+                continue
+            messages[(lang_code, key, None)] = message
+            if not isinstance(message, MappingProxyType):
+                continue
+            default_message = default_pack.get(key)
+            bot_ids = set(message)
+            if isinstance(default_message, MappingProxyType):
+                bot_ids |= set(default_message)
+            for bot_id in bot_ids:
+                bot_message = message.get(bot_id)
+                if not bot_message and isinstance(default_message, MappingProxyType):
+                    bot_message = default_message.get(bot_id)
+                messages[(lang_code, key, bot_id)] = bot_message or message
+    return messages
+
+
+def _build_language_keyboard(languages) -> Optional[InlineKeyboardMarkup]:
+    if not languages:
+        return None
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text=language["text"], callback_data=f"lang_{language['code']}")]
+         for language in languages])
+
+
+def _build_context_keyboard(contexts) -> Optional[InlineKeyboardMarkup]:
+    if not contexts:
+        return None
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(context["label"], callback_data=f'contextname_{context["value"]}')]
+         for context in contexts])
+
+
+def language_init(settings: Optional[Settings] = None):
+    """
+    Loads language JSON files and compiles the language catalog used by the lookups below.
+    Called again with new settings when the configuration is reloaded.
+    """
+    global language_dict, default_lang, languages_array, _catalog
+    settings = settings or get_settings()
+
+    packs = {}
     for filename in glob.glob('./languages/*.json'):
         lang_code = filename.split('/')[-1].split('.')[0]
         with open(filename, 'r') as f:
-            language_dict[lang_code] = json.load(f)
+            packs[lang_code] = _freeze(json.load(f))
+    try:
+        # Context indexes are stored in packed preferences, so every pack must agree on them
+        check_catalog_indexes([context for pack in packs.values() for context in pack.get("context", ())], "value")
+    except ValueError as e:
+        raise ValueError(f"Invalid context in the language packs: {e}")
 
-def get_message(language=default_lang, key=None, bot_id=None):
-    """Retrieves a message from the language dictionary, handling fallbacks."""
+    supported_languages = os.getenv('SUPPORTED_LANGUAGES', "").split(",")
+    languages = tuple(_freeze(dict(language)) for language in settings.default.languages
+                      if language["code"] in supported_languages)
+
+    messages = _compile_messages(packs, settings.default.language)
+    context_keyboards = {}
+    for lang_code in packs:
+        keyboard = _build_context_keyboard(messages.get((lang_code, "context", None)))
+        if keyboard:
+            context_keyboards[lang_code] = keyboard
+
+    # Swap the whole catalog in one assignment so readers never see a half built one
+    _catalog = LanguageCatalog(messages, languages, _build_language_keyboard(languages), context_keyboards,
+                               settings.default.language)
+    language_dict = packs
+    default_lang = settings.default.language
+    languages_array = list(languages)
+    logger.info({"category": "language_init", "languages": list(packs), "supported": [l["code"] for l in languages]})
+
+
+def get_message(language=None, key=None, bot_id=None):
+    """Retrieves a message from the language catalog, handling fallbacks."""
+
+    catalog = _catalog
+    default_language = catalog.default_language
+    language = language or default_language
+    message = catalog.messages.get((language, key, bot_id))
+    if message is None and bot_id is not None:
+        message = catalog.messages.get((language, key, None))
+    if message is None and language != default_language:
+        logger.debug("❌ Object doesn't exist for %s.%s, using %s", language, key, default_language)
+        return get_message(default_language, key, bot_id)
+    return message
 
-    message = None
-    try:
-        if bot_id:
-            message = language_dict[language].get(key, {}).get(bot_id)
-        if not message:
-            message = language_dict[language].get(key)
-        if message:
-            return json.loads(json.dumps(message))
-    except KeyError:
-        logger.warn(f"❌ Object doesn't exist for {language}.{key}")
-        logger.info(f"Getting default language (en) message for key: {key}")
-        if bot_id:
-            message = language_dict[default_lang].get(key, {}).get(bot_id)
-        if not message:
-            message = language_dict[default_lang].get(key)
-        if message:
-            return json.loads(json.dumps(message))
-    return None
 
 def get_languages():
-    """Returns the global languages array."""
-    languages = os.getenv('SUPPORTED_LANGUAGES', "").split(",")
-    return list(filter(lambda x: x.get("code") in languages , json.loads(get_config_value('default', 'languages', None))))
\ No newline at end of file
+    """Returns the supported languages, in the order configured in config.ini."""
+    return _catalog.languages
+
+
+def get_language_keyboard() -> Optional[InlineKeyboardMarkup]:
+    """Returns the prebuilt language selection keyboard, or None if no language is supported."""
+    return _catalog.language_keyboard
+
+
+def get_context_keyboard(language=None) -> Optional[InlineKeyboardMarkup]:
+    """Returns the prebuilt context selection keyboard for a language, or None if it has no contexts."""
+    catalog = _catalog
+    keyboards = catalog.context_keyboards
+    return keyboards.get(language) or keyboards.get(catalog.default_language)
@@ -1,26 +1,121 @@
+import atexit
+import copy
+import json
 import logging
+import multiprocessing.util
 import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 
 load_dotenv()
 logger_name = os.environ['TELEGRAM_BOT_NAME']
 
 log_level = os.environ["LOG_LEVEL"]
+# text for the plain line format, or json for one object per line
+log_output_format = os.getenv('LOG_FORMAT', 'text').lower()
+log_queue_size = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Comma separated category=rate, e.g. "query_handler=0.1,uvicorn.access=0.01,*=1". WARNING and above are always kept
+log_sample_rates = os.getenv('LOG_SAMPLE_RATES', '')
 
 log_format = '%(asctime)s - %(thread)d - %(threadName)s - %(name)s - %(levelname)s - %(message)s'
-logging.basicConfig(
-    level=log_level,
-    format=log_format,
-    datefmt='%Y-%m-%d %H:%M:%S',
-)
+date_format = '%Y-%m-%d %H:%M:%S'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line. Dict messages are merged into the object instead of being printed as a string."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, date_format),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+        }
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a configured fraction of the records of each category: the `category` of a
+    dict message, or else the logger name. Records at WARNING and above are always kept.
+    """
+
+    def __init__(self, rates: str):
+        super().__init__()
+        self.rates = {}
+        for item in filter(None, rates.split(",")):
+            category, _, rate = item.partition("=")
+            self.rates[category.strip()] = float(rate)
+        self.default_rate = self.rates.pop("*", 1.0)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not (self.rates or self.default_rate < 1):
+            return True
+        category = record.msg.get("category") if isinstance(record.msg, dict) else None
+        rate = self.rates.get(category or record.name, self.default_rate)
+        return rate >= 1 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Only puts the record on the queue: formatting and writing happen on the listener
+    thread. Below WARNING, a record is dropped rather than wait when the queue is full.
+    """
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The base class formats the whole record here, on the caller's thread. Only what the
+        # caller may still change is fixed: a copy of a dict message, or the message text.
+        record = copy.copy(record)
+        if isinstance(record.msg, dict):
+            record.msg = dict(record.msg)
+        else:
+            record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(JsonFormatter() if log_output_format == "json" else logging.Formatter(log_format, date_format))
+_queue = queue.Queue(maxsize=log_queue_size)
+_queue_handler = NonBlockingQueueHandler(_queue)
+_queue_handler.addFilter(SamplingFilter(log_sample_rates))
+logging.basicConfig(level=log_level, handlers=[_queue_handler])
+
+# The listener thread does the formatting and the writes
+_listener = QueueListener(_queue, _stream_handler, respect_handler_level=True)
+_listener.start()
+
+
+def flush_logs():
+    """Writes out everything still queued and stops the listener thread. Runs once, on process exit."""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+
+
+atexit.register(flush_logs)
+# uvicorn worker processes are multiprocessing children, which exit without running atexit hooks
+multiprocessing.util.Finalize(None, flush_logs, exitpriority=-100)
 
 # Configure the logger
 logger = logging.getLogger(logger_name)
-# logger.setLevel(log_level)
-
-# Example usage
-# logger.debug("This is a debug message.")
-# logger.info("This is an info message.")
-# logger.warning("This is a warning message.")
-# logger.error("This is an error message.")
-# logger.critical("This is a critical message.")
\ No newline at end of file
@@ -0,0 +1,158 @@
+import asyncio
+import functools
+import glob
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Optional, Sequence
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Seconds, from a Redis round trip up to a slow LLM answer
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Seconds between copies of the counts the worker's components keep into their metrics
+metrics_sample_interval = float(os.getenv('METRICS_SAMPLE_INTERVAL', '5'))
+
+HANDLER_LATENCY = Histogram("telegram_handler_duration_seconds", "Time spent in each update handler",
+                            ("handler", "status"), buckets=DEFAULT_BUCKETS)
+BACKEND_LATENCY = Histogram("sakhi_backend_request_duration_seconds", "Sakhi API calls by context and outcome",
+                            ("context", "status"), buckets=DEFAULT_BUCKETS)
+REDIS_LATENCY = Histogram("redis_command_duration_seconds", "Redis round trips by command", ("command",),
+                          buckets=DEFAULT_BUCKETS)
+TELEGRAM_API_LATENCY = Histogram("telegram_api_request_duration_seconds",
+                                 "Bot API calls by method and outcome, retry_after being a 429", ("method", "status"),
+                                 buckets=DEFAULT_BUCKETS)
+
+
+def multiprocess_mode() -> bool:
+    """True when every worker writes its metrics under PROMETHEUS_MULTIPROC_DIR, as with UVICORN_WORKERS > 1."""
+    return bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+
+class _Sampled:
+    """A metric whose values are copied from `function`, returning `{label values: value}`."""
+
+    def __init__(self, metric, function: Callable[[], Dict[tuple, float]]):
+        self.metric = metric
+        self.function = function
+        self._last: Dict[tuple, float] = {}
+
+    def _child(self, labelvalues: tuple):
+        return self.metric.labels(*labelvalues) if labelvalues else self.metric
+
+    def sample(self):
+        for labelvalues, value in list(self.function().items()):
+            if isinstance(self.metric, Counter):
+                # Counters only go up, so the count kept elsewhere is added as it grows
+                last = self._last.get(labelvalues, 0)
+                if value > last:
+                    self._child(labelvalues).inc(value - last)
+                self._last[labelvalues] = value
+            else:
+                self._child(labelvalues).set(value)
+
+
+_sampled: Dict[str, _Sampled] = {}
+
+
+def _register_sampled(name: str, build: Callable[[], object], function: Callable[[], Dict[tuple, float]]):
+    # Registering a name again keeps its metric and reads the new function, e.g. when an application is rebuilt
+    sampled = _sampled.get(name)
+    if sampled is None:
+        _sampled[name] = _Sampled(build(), function)
+    else:
+        sampled.function = function
+
+
+def sampled_counter(name: str, documentation: str, labelnames: Sequence[str] = (),
+                    function: Optional[Callable[[], Dict[tuple, float]]] = None):
+    """A counter following a count another object already keeps, read by `sample_metrics`."""
+    _register_sampled(name, lambda: Counter(name, documentation, labelnames), function)
+
+
+def sampled_gauge(name: str, documentation: str, labelnames: Sequence[str] = (),
+                  function: Optional[Callable[[], Dict[tuple, float]]] = None):
+    """
+    A gauge following a value another object already keeps, read by `sample_metrics`.
+    In multiprocess mode the workers' values are summed, and a worker that exited drops out.
+    """
+    _register_sampled(name, lambda: Gauge(name, documentation, labelnames, multiprocess_mode="livesum"), function)
+
+
+def sample_metrics():
+    for sampled in list(_sampled.values()):
+        sampled.sample()
+
+
+def prepare_multiprocess_dir() -> Optional[str]:
+    """
+    Points PROMETHEUS_MULTIPROC_DIR, or a new temporary directory if it is unset, at an empty
+    directory. Called before the worker processes start, which inherit it; files left by an
+    earlier run would add its counts to this one's. Returns the temporary directory, if any,
+    for the caller to remove once the workers are gone.
+    """
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    created = None
+    if not path:
+        path = created = tempfile.mkdtemp(prefix="sakhi_metrics_")
+    os.makedirs(path, exist_ok=True)
+    for name in glob.glob(os.path.join(path, "*.db")):
+        os.remove(name)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return created
+
+
+def render() -> bytes:
+    """Renders the metrics in the Prometheus text format, those of every worker in multiprocess mode."""
+    if not multiprocess_mode():
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+class MetricsSampler:
+    """
+    Copies the counts the worker's components keep into their metrics every `interval` seconds.
+    In multiprocess mode the other workers' values are only as fresh as their last sample.
+    """
+
+    def __init__(self, interval=metrics_sample_interval):
+        self.interval = interval
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sample_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if multiprocess_mode():
+            # Removes this worker's gauges; its counters and histograms keep counting toward the totals
+            multiprocess.mark_process_dead(os.getpid())
+
+    async def _sample_loop(self):
+        while True:
+            sample_metrics()
+            await asyncio.sleep(self.interval)
+
+
+def timed_handler(callback):
+    """Wraps a PTB handler callback to record its duration, labelled with its name."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = await callback(update, context)
+            status = "ok"
+            return result
+        finally:
+            HANDLER_LATENCY.labels(name, status).observe(time.perf_counter() - start)
+
+    return wrapper
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Moves chat preferences from the per-chat keys into the bucketed layout, while the bot keeps running.
+
+Run it after the bot is deployed with PREFERENCE_STORAGE=bucketed and PREFERENCE_LEGACY_READS=true,
+so that the bot writes to the buckets and still reads the chats that are not migrated yet. The script scans `<chat_id>_preferences`, `<chat_id>_language` and
+`<chat_id>_context`, and adds each chat to its bucket unless the bot already wrote it there, so
+it never overwrites a newer choice and can be stopped and run again at any time. With --delete,
+the old keys of each migrated chat are removed. Once a run finds nothing left, legacy reads can
+be turned off.
+
+Usage:
+    python migrate_preferences.py [--batch 500] [--pause 0.05] [--delete] [--dry-run]
+"""
+import argparse
+import asyncio
+import time
+from typing import Tuple
+
+from language_util import language_init
+from logger import logger
+from preference_store import Preferences, PreferenceStore, _decode
+from redis_util import close_redis, get_redis
+
+SUFFIXES = ("_preferences", "_language", "_context")
+
+
+def _chat_id(key: bytes):
+    """Returns the chat id of a per-chat preference key, or None for any other key."""
+    name = key.decode('utf-8', 'replace')
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            try:
+                return int(name[:-len(suffix)])
+            except ValueError:
+                return None
+    return None
+
+
+async def migrate_batch(store: PreferenceStore, chat_ids, delete: bool, dry_run: bool) -> Tuple[int, int]:
+    redis = get_redis()
+    async with redis.pipeline(transaction=False) as pipe:
+        for chat_id in chat_ids:
+            pipe.hmget(store.record_key(chat_id), "language", "context")
+            pipe.mget(f"{chat_id}_language", f"{chat_id}_context")
+        results = await pipe.execute()
+
+    found = 0
+    added_at = []  # position of each chat's HSETNX in the pipeline
+    async with redis.pipeline(transaction=False) as pipe:
+        for index, chat_id in enumerate(chat_ids):
+            (language, context), (legacy_language, legacy_context) = results[2 * index:2 * index + 2]
+            preferences = Preferences(language=_decode(language or legacy_language),
+                                      context=_decode(context or legacy_context))
+            if preferences.language is None and preferences.context is None:
+                continue
+            found += 1
+            if dry_run:
+                continue
+            added_at.append(len(pipe))
+            store.write(pipe, chat_id, preferences, only_new=True)
+            if delete:
+                pipe.delete(store.record_key(chat_id), f"{chat_id}_language", f"{chat_id}_context")
+        written = await pipe.execute() if not dry_run else []
+    return found, sum(1 for position in added_at if written[position])
+
+
+async def migrate(batch: int, pause: float, delete: bool, dry_run: bool):
+    language_init()
+    store = PreferenceStore(storage="bucketed")
+    redis = get_redis()
+    started = time.monotonic()
+    scanned = found = added = 0
+    for suffix in SUFFIXES:
+        # A chat with several old keys comes up once per key; migrating it again is a no-op
+        pending = set()
+        async for key in redis.scan_iter(match=f"*{suffix}", count=batch):
+            scanned += 1
+            chat_id = _chat_id(key)
+            if chat_id is None:
+                continue
+            pending.add(chat_id)
+            if len(pending) >= batch:
+                batch_found, batch_added = await migrate_batch(store, list(pending), delete, dry_run)
+                found, added, pending = found + batch_found, added + batch_added, set()
+                # Leaves room for the bot's own Redis traffic
+                await asyncio.sleep(pause)
+        if pending:
+            batch_found, batch_added = await migrate_batch(store, list(pending), delete, dry_run)
+            found, added = found + batch_found, added + batch_added
+    # `added` leaves out chats the bot had already written to their bucket
+    logger.info({"category": "migrate_preferences", "label": "done", "scanned": scanned, "found": found,
+                 "added": added, "deleted": delete and not dry_run, "dry_run": dry_run,
+                 "seconds": round(time.monotonic() - started, 1)})
+    await close_redis()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move chat preferences into the bucketed Redis layout")
+    parser.add_argument("--batch", type=int, default=500, help="keys scanned and chats migrated per round trip")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to wait between batches")
+    parser.add_argument("--delete", action="store_true", help="remove the old keys of every migrated chat")
+    parser.add_argument("--dry-run", action="store_true", help="only count the chats that would be migrated")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.batch, args.pause, args.delete, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Iterable, Mapping, NamedTuple, Optional
+
+from redis.exceptions import RedisError, WatchError
+
+import language_util
+from config_util import get_settings
+from logger import logger
+from redis_util import get_redis
+
+preference_cache_size = int(os.getenv('PREFERENCE_CACHE_SIZE', '100000'))
+preference_cache_ttl = float(os.getenv('PREFERENCE_CACHE_TTL', '300'))
+preference_channel = os.getenv('PREFERENCE_INVALIDATION_CHANNEL', 'sakhi_preferences_invalidate')
+# hash: one Redis hash per chat. bucketed: chats packed into shared hashes, see PreferenceCodec
+preference_storage = os.getenv('PREFERENCE_STORAGE', 'hash').lower()
+# Chats per bucket; keep it under the server's hash-max-listpack-entries (128 by default)
+preference_bucket_size = int(os.getenv('PREFERENCE_BUCKET_SIZE', '100'))
+# Seconds after which the preferences of a chat that was not seen expire, 0 to keep them forever.
+# In bucketed storage this uses HEXPIRE, which needs Redis 7.4 or later
+preference_ttl = int(os.getenv('PREFERENCE_TTL', '0'))
+# In bucketed storage, also read the per-chat hashes and the older keys until they are migrated
+preference_legacy_reads = os.getenv('PREFERENCE_LEGACY_READS', 'true').lower() == 'true'
+# Attempts at a bucketed write before giving up when other chats of the bucket keep changing
+BUCKET_WRITE_ATTEMPTS = 10
+
+
+class Preferences(NamedTuple):
+    language: Optional[str] = None
+    context: Optional[str] = None
+
+
+EMPTY_PREFERENCES = Preferences()
+
+
+def _decode(value) -> Optional[str]:
+    return value.decode('utf-8') if value is not None else None
+
+
+class PreferenceCodec:
+    """
+    Packs a chat's language and context into one small integer for bucketed storage.
+
+    Each code is stored as its `index` in the catalogs, the `languages` of config.ini and
+    the `context` lists of the language packs, plus one so that 0 means not set: the
+    language in the low byte, the context in the next one. Those indexes are stored
+    data, so they must never be renumbered. Codes missing from the catalogs are stored
+    as `language|context` text instead.
+    """
+
+    def __init__(self, languages: Iterable[Mapping], contexts: Iterable[Mapping]):
+        self.language_slots = {language["code"]: int(language["index"]) + 1 for language in languages}
+        self.context_slots = {context["value"]: int(context["index"]) + 1 for context in contexts}
+        self.languages = {slot: code for code, slot in self.language_slots.items()}
+        self.contexts = {slot: code for code, slot in self.context_slots.items()}
+
+    def encode(self, preferences: Preferences) -> str:
+        language_slot = self.language_slots.get(preferences.language) if preferences.language else 0
+        context_slot = self.context_slots.get(preferences.context) if preferences.context else 0
+        if language_slot is None or context_slot is None or language_slot > 255 or context_slot > 255:
+            return f"{preferences.language or ''}|{preferences.context or ''}"
+        return str(language_slot | context_slot << 8)
+
+    def decode(self, value: bytes) -> Preferences:
+        text = value.decode('utf-8')
+        if text.isdigit():
+            packed = int(text)
+            return Preferences(language=self.languages.get(packed & 255), context=self.contexts.get(packed >> 8))
+        language, _, context = text.partition("|")
+        return Preferences(language=language or None, context=context or None)
+
+
+def catalog_codec() -> PreferenceCodec:
+    """Builds the codec from the current settings and the language packs loaded by `language_init`."""
+    contexts = [context for pack in language_util.language_dict.values() for context in pack.get("context", ())]
+    return PreferenceCodec(get_settings().default.languages, contexts)
+
+
+class PreferenceStore:
+    """
+    Per-chat language/context preferences kept in Redis, fronted by a bounded
+    in-process LRU cache with a TTL.
+
+    With `storage` hash every chat has its own Redis hash. With bucketed, chats are
+    grouped by id into hashes of `bucket_size` fields, small enough for Redis's packed
+    encoding, each holding the chat's preferences packed by `PreferenceCodec`; until
+    migrate_preferences.py has run, reads fall back to the per-chat layouts.
+    When `record_ttl` is set, the preferences of a chat expire that long after it was
+    last loaded or written.
+
+    Writes go through to Redis and are announced on a pub/sub channel so that
+    other workers drop their cached copy of that chat.
+    """
+
+    def __init__(self, max_entries=preference_cache_size, ttl=preference_cache_ttl, channel=preference_channel,
+                 storage=preference_storage, bucket_size=preference_bucket_size, record_ttl=preference_ttl,
+                 legacy_reads=preference_legacy_reads):
+        if storage not in ("hash", "bucketed"):
+            raise ValueError(f"PREFERENCE_STORAGE must be hash or bucketed, not '{storage}'")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.channel = channel
+        self.storage = storage
+        self.bucket_size = bucket_size
+        self.record_ttl = record_ttl
+        self.legacy_reads = legacy_reads
+        self._cache = OrderedDict()  # chat_id -> (expires_at, Preferences)
+        self._origin = uuid.uuid4().hex
+        self._listener_task = None
+        self._codec = None
+        self._codec_sources = None
+
+    @staticmethod
+    def record_key(chat_id) -> str:
+        return f"{chat_id}_preferences"
+
+    def bucket_slot(self, chat_id) -> tuple:
+        """Returns the bucket hash and the field holding a chat, in bucketed storage."""
+        chat_id = int(chat_id)
+        return f"preferences_bucket_{chat_id // self.bucket_size}", str(chat_id % self.bucket_size)
+
+    @property
+    def codec(self) -> PreferenceCodec:
+        # Rebuilt when a configuration reload swaps the settings or the language packs
+        sources = (get_settings(), language_util.language_dict)
+        if self._codec_sources is None or any(a is not b for a, b in zip(sources, self._codec_sources)):
+            self._codec, self._codec_sources = catalog_codec(), sources
+        return self._codec
+
+    def _cache_get(self, chat_id) -> Optional[Preferences]:
+        entry = self._cache.get(chat_id)
+        if entry is None:
+            return None
+        expires_at, preferences = entry
+        if expires_at < time.monotonic():
+            self._cache.pop(chat_id, None)
+            return None
+        self._cache.move_to_end(chat_id)
+        return preferences
+
+    def _cache_put(self, chat_id, preferences: Preferences):
+        self._cache[chat_id] = (time.monotonic() + self.ttl, preferences)
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        self._cache.pop(chat_id, None)
+
+    async def _load(self, chat_id) -> Preferences:
+        # The per-chat record and the legacy `<chat_id>_language` / `<chat_id>_context`
+        # keys are read in the same round trip so that old users keep their settings.
+        bucketed = self.storage == "bucketed"
+        async with get_redis().pipeline(transaction=False) as pipe:
+            if bucketed:
+                bucket, field = self.bucket_slot(chat_id)
+                pipe.hget(bucket, field)
+                if self.record_ttl:
+                    pipe.hexpire(bucket, self.record_ttl, field)
+            elif self.record_ttl:
+                pipe.expire(self.record_key(chat_id), self.record_ttl)
+            if not bucketed or self.legacy_reads:
+                pipe.hmget(self.record_key(chat_id), "language", "context")
+                pipe.mget(f"{chat_id}_language", f"{chat_id}_context")
+            results = await pipe.execute()
+        if bucketed:
+            packed = results[0]
+            if packed is not None or not self.legacy_reads:
+                return self.codec.decode(packed) if packed is not None else EMPTY_PREFERENCES
+        (language, context), (legacy_language, legacy_context) = results[-2:]
+        return Preferences(language=_decode(language or legacy_language),
+                           context=_decode(context or legacy_context))
+
+    def write(self, pipe, chat_id, preferences: Preferences, only_new=False):
+        """
+        Queues the write of a chat's preferences on a pipeline, in the configured storage.
+        With `only_new`, as used by the migration, a chat already in its bucket is left alone.
+        """
+        if self.storage == "bucketed":
+            bucket, field = self.bucket_slot(chat_id)
+            value = self.codec.encode(preferences)
+            if only_new:
+                pipe.hsetnx(bucket, field, value)
+            else:
+                pipe.hset(bucket, field, value)
+            if self.record_ttl:
+                pipe.hexpire(bucket, self.record_ttl, field)
+            return
+        fields = {name: value for name, value in preferences._asdict().items() if value is not None}
+        if fields:
+            pipe.hset(self.record_key(chat_id), mapping=fields)
+        if self.record_ttl:
+            pipe.expire(self.record_key(chat_id), self.record_ttl)
+
+    async def get(self, chat_id) -> Preferences:
+        """Returns the stored preferences of a chat, fields are None when never set."""
+        preferences = self._cache_get(chat_id)
+        if preferences is not None:
+            return preferences
+        try:
+            preferences = await self._load(chat_id)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            # Serve defaults rather than stalling the chat, and don't cache the miss
+            logger.error({"category": "preference_store", "label": "load_failed", "id": chat_id, "error": str(e)})
+            return EMPTY_PREFERENCES
+        self._cache_put(chat_id, preferences)
+        return preferences
+
+    async def _set_bucketed(self, chat_id, fields: dict) -> Preferences:
+        """
+        Changes some fields of a chat's packed value in its bucket, reading the stored value
+        under WATCH so that a concurrent change to the other field is never written over.
+        """
+        bucket, field = self.bucket_slot(chat_id)
+        async with get_redis().pipeline(transaction=True) as pipe:
+            for _ in range(BUCKET_WRITE_ATTEMPTS):
+                try:
+                    await pipe.watch(bucket)
+                    packed = await pipe.hget(bucket, field)
+                    if packed is not None:
+                        current = self.codec.decode(packed)
+                    elif self.legacy_reads:
+                        # Also watched, so that a chat being migrated is read as the migration left it
+                        await pipe.watch(self.record_key(chat_id), f"{chat_id}_language", f"{chat_id}_context")
+                        language, context = await pipe.hmget(self.record_key(chat_id), "language", "context")
+                        legacy_language, legacy_context = await pipe.mget(f"{chat_id}_language", f"{chat_id}_context")
+                        current = Preferences(language=_decode(language or legacy_language),
+                                              context=_decode(context or legacy_context))
+                    else:
+                        current = EMPTY_PREFERENCES
+                    preferences = current._replace(**fields)
+                    pipe.multi()
+                    self.write(pipe, chat_id, preferences)
+                    pipe.publish(self.channel, f"{self._origin}:{chat_id}")
+                    await pipe.execute()
+                    return preferences
+                except WatchError:
+                    continue
+        raise WatchError(f"Preferences of chat {chat_id} kept changing during {BUCKET_WRITE_ATTEMPTS} attempts")
+
+    async def set(self, chat_id, language: str = None, context: str = None):
+        """
+        Writes the given fields through to Redis and invalidates other workers' caches.
+        Fields left as None keep their stored value, whatever this worker has cached.
+        """
+        fields = {name: value for name, value in (("language", language), ("context", context)) if value is not None}
+        if not fields:
+            return
+        if self.storage == "bucketed":
+            self._cache_put(chat_id, await self._set_bucketed(chat_id, fields))
+            return
+        # Only the changed fields are written, the hash keeps the others as they are in Redis
+        async with get_redis().pipeline(transaction=False) as pipe:
+            self.write(pipe, chat_id, Preferences(**fields))
+            pipe.publish(self.channel, f"{self._origin}:{chat_id}")
+            await pipe.execute()
+        cached = self._cache_get(chat_id)
+        if cached is not None:
+            self._cache_put(chat_id, cached._replace(**fields))
+
+    async def _listen(self):
+        while True:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None:
+                        continue
+                    origin, _, chat_id = _decode(message["data"]).partition(":")
+                    if origin != self._origin:
+                        self.invalidate(int(chat_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Entries we may have missed are stale at most until their TTL expires
+                logger.error({"category": "preference_store", "label": "invalidation_listener", "error": str(e)})
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def start(self):
+        """Starts listening for invalidations published by other workers."""
+        if self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            await asyncio.gather(self._listener_task, return_exceptions=True)
+            self._listener_task = None
+
+
+preference_store = PreferenceStore()
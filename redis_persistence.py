@@ -0,0 +1,237 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from redis.exceptions import RedisError
+from telegram.ext import BasePersistence, PersistenceInput
+
+from logger import logger
+from redis_util import get_redis
+
+# Seconds between the application's runs of update_persistence, each flushed as one pipeline
+persistence_update_interval = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '10'))
+# Users and chats whose stored record each worker remembers to skip unchanged writes
+persistence_cache_size = int(os.getenv('PERSISTENCE_CACHE_SIZE', '10000'))
+
+_REDIS_ERRORS = (RedisError, OSError, asyncio.TimeoutError)
+
+# A stored record: field -> JSON encoded value
+Record = Dict[str, str]
+
+
+def _encode(data: dict, kind: str, key) -> Record:
+    record = {}
+    for field, value in data.items():
+        try:
+            record[str(field)] = json.dumps(value, ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.error({"category": "redis_persistence", "label": "not_serializable", "kind": kind, "id": key,
+                          "field": str(field), "error": str(e)})
+    return record
+
+
+def _decode(record: dict, kind: str, key) -> dict:
+    data = {}
+    for field, value in record.items():
+        field = field.decode('utf-8')
+        try:
+            data[field] = json.loads(value)
+        except ValueError as e:
+            # One corrupt field must not break every update of its user or chat
+            logger.error({"category": "redis_persistence", "label": "not_decodable", "kind": kind, "id": key,
+                          "field": field, "error": str(e)})
+    return data
+
+
+class RedisPersistence(BasePersistence):
+    """
+    Keeps PTB's user_data, chat_data and bot_data in Redis, one hash per user or chat
+    with a JSON value per field.
+
+    Nothing is loaded at startup apart from bot_data: a user's or chat's data is read
+    the first time one of its updates is processed, with concurrent first accesses
+    sharing one read. Writes are deferred: the application hands over the data it
+    touched every `update_interval` seconds, fields whose value did not change since the
+    last write are skipped, and what is left goes out as a single pipeline. Each worker
+    only writes the fields it changed, so workers sharing a user don't overwrite each
+    other's untouched fields. The stored copy those checks compare against is only kept
+    for the `cache_size` most recently active users and chats. Conversations and
+    callback data are not stored.
+    """
+
+    def __init__(self, namespace: str, update_interval=persistence_update_interval, cache_size=persistence_cache_size):
+        super().__init__(store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.namespace = namespace
+        self.cache_size = cache_size
+        # (kind, id) -> the record as last read from or written to Redis, least recently used first
+        self._persisted: Dict[Tuple[str, Optional[int]], Record] = OrderedDict()
+        # (kind, id) -> record waiting to be written, None to delete it
+        self._pending: Dict[Tuple[str, Optional[int]], Optional[Record]] = {}
+        # What the running flush is writing
+        self._flushing: Dict[Tuple[str, Optional[int]], Optional[Record]] = {}
+        self._loading: Dict[Tuple[str, Optional[int]], asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.writes = 0
+        self.skipped_writes = 0
+
+    def _key(self, kind: str, key: Optional[int]) -> str:
+        return f"{self.namespace}_{kind}" if key is None else f"{self.namespace}_{kind}_{key}"
+
+    async def _read(self, kind: str, key: Optional[int]) -> Optional[dict]:
+        """Reads a record once per process. Returns None if it was read before or cannot be read."""
+        record_id = (kind, key)
+        if record_id in self._persisted:
+            self._persisted.move_to_end(record_id)
+            return None
+        loading = self._loading.get(record_id)
+        if loading is not None:
+            await asyncio.shield(loading)
+            return None
+        loading = self._loading[record_id] = asyncio.get_running_loop().create_future()
+        try:
+            record = await get_redis().hgetall(self._key(kind, key))
+            self._remember(record_id, {field.decode('utf-8'): value.decode('utf-8')
+                                       for field, value in record.items()})
+            self.loads += 1
+            return _decode(record, kind, key)
+        except _REDIS_ERRORS as e:
+            # Go on with what is in memory and try again on the next update
+            logger.error({"category": "redis_persistence", "label": "load_failed", "kind": kind, "id": key,
+                          "error": str(e)})
+            return None
+        finally:
+            del self._loading[record_id]
+            loading.set_result(None)
+
+    def _remember(self, record_id: Tuple[str, Optional[int]], record: Record):
+        self._persisted[record_id] = record
+        self._persisted.move_to_end(record_id)
+        excess = len(self._persisted) - self.cache_size
+        if excess <= 0:
+            return
+        # Only user and chat records with no write pending are forgotten, the least recently
+        # used first, so their changes were handed over and written long ago. The next update
+        # of such a user or chat reads the record again before its data is handed over.
+        for record_id in list(self._persisted):
+            if excess <= 0:
+                break
+            if record_id[1] is not None and record_id not in self._pending and record_id not in self._flushing:
+                del self._persisted[record_id]
+                excess -= 1
+
+    async def _refresh(self, kind: str, key: Optional[int], data: dict):
+        loaded = await self._read(kind, key)
+        if loaded:
+            for field, value in loaded.items():
+                # Values set by a handler that ran before the read finished are newer
+                data.setdefault(field, value)
+
+    def _stage(self, kind: str, key: Optional[int], record: Optional[Record]):
+        record_id = (kind, key)
+        if record is not None and record == self._persisted.get(record_id) and record_id not in self._flushing:
+            # Unchanged since it was read or last written, or changed back
+            self._pending.pop(record_id, None)
+            self.skipped_writes += 1
+            return
+        self._pending[record_id] = record
+        if self._flush_task is None or self._flush_task.done():
+            # The application stages everything it touched in one gather, the flush runs after it
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending:
+            pending = self._flushing = self._pending
+            self._pending = {}
+            try:
+                async with get_redis().pipeline(transaction=False) as pipe:
+                    for (kind, key), record in pending.items():
+                        redis_key = self._key(kind, key)
+                        if record is None:
+                            pipe.delete(redis_key)
+                            continue
+                        persisted = self._persisted.get((kind, key), {})
+                        changed = {field: value for field, value in record.items() if persisted.get(field) != value}
+                        removed = [field for field in persisted if field not in record]
+                        if changed:
+                            pipe.hset(redis_key, mapping=changed)
+                        if removed:
+                            pipe.hdel(redis_key, *removed)
+                    await pipe.execute()
+            except _REDIS_ERRORS as e:
+                # Keep what was not staged again since, for the next run
+                for record_id, record in pending.items():
+                    self._pending.setdefault(record_id, record)
+                logger.error({"category": "redis_persistence", "label": "flush_failed", "records": len(pending),
+                              "error": str(e)})
+                return
+            finally:
+                self._flushing = {}
+            for record_id, record in pending.items():
+                self._remember(record_id, record or {})
+            self.writes += len(pending)
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return await self._read("bot_data", None) or {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage("user_data", user_id, _encode(data, "user_data", user_id))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._stage("chat_data", chat_id, _encode(data, "chat_data", chat_id))
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._stage("bot_data", None, _encode(data, "bot_data", None))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage("user_data", user_id, None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage("chat_data", chat_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh("user_data", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh("chat_data", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Writes whatever is still pending. Called by the application when it shuts down."""
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self._flush()
+
+    def stats(self) -> dict:
+        return {
+            "loaded": len(self._persisted),
+            "loads": self.loads,
+            "writes": self.writes,
+            "skipped_writes": self.skipped_writes,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,58 @@
+import os
+import time
+from typing import Optional
+
+import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
+
+from metrics import REDIS_LATENCY
+
+redis_host = os.getenv("REDIS_HOST", "172.17.0.1")
+redis_port = int(os.getenv("REDIS_PORT", "6379"))
+redis_index = int(os.getenv("REDIS_INDEX", "1"))
+redis_max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", "256"))
+redis_socket_timeout = float(os.getenv("REDIS_SOCKET_TIMEOUT", "2"))
+
+_client: Optional[aioredis.Redis] = None
+
+
+class _TimedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels("PIPELINE").observe(time.perf_counter() - start)
+
+
+class _TimedRedis(aioredis.Redis):
+    """Records the round trip of every command, and of every pipeline as one, in redis_command_duration_seconds."""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(args[0]).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> Pipeline:
+        return _TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def get_redis() -> aioredis.Redis:
+    """Returns the process wide async Redis client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = _TimedRedis(host=redis_host, port=redis_port, db=redis_index,
+                              max_connections=redis_max_connections,
+                              socket_timeout=redis_socket_timeout,
+                              socket_connect_timeout=redis_socket_timeout)
+    return _client
+
+
+async def close_redis() -> None:
+    """Closes the shared client and its connection pool."""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
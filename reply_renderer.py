@@ -0,0 +1,143 @@
+import asyncio
+import os
+from typing import List, Optional
+
+from telegram import Bot, InlineKeyboardMarkup, Message
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, TelegramError
+from telegram.helpers import escape_markdown
+
+from logger import logger
+from send_scheduler import PRIORITY_ANSWER, PRIORITY_NORMAL
+
+stream_edit_interval = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+# Characters escape_markdown prefixes with a backslash in legacy Markdown
+_MARKDOWN_SPECIAL = "_*`["
+# Preferred places to split a long reply, best first
+_BOUNDARIES = ("\n\n", "\n", ". ", " ")
+
+
+def _length(char: str, markdown: bool) -> int:
+    # Telegram counts UTF-16 code units, so characters outside the BMP count twice
+    length = 2 if ord(char) > 0xFFFF else 1
+    return length + 1 if markdown and char in _MARKDOWN_SPECIAL else length
+
+
+def split_reply(text: str, markdown=True, limit=MessageLimit.MAX_TEXT_LENGTH) -> List[str]:
+    """
+    Splits `text` into parts that each fit in one message once escaped.
+
+    Parts end on a paragraph, line, sentence or word boundary where one exists in the
+    second half of the part. The text is split before it is escaped, so an escape
+    sequence is never cut in two.
+    """
+    parts = []
+    while text:
+        end = size = 0
+        for char in text:
+            size += _length(char, markdown)
+            if size > limit:
+                break
+            end += 1
+        if end == len(text):
+            parts.append(text)
+            break
+        cut = end
+        for boundary in _BOUNDARIES:
+            index = text.rfind(boundary, 0, end)
+            if index > end // 2:
+                cut = index + len(boundary)
+                break
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    return parts
+
+
+async def render_reply(bot: Bot, chat_id: int, placeholder: Optional[Message], text: str,
+                       reply_markup: InlineKeyboardMarkup = None, markdown=False,
+                       rate_limit_args=PRIORITY_ANSWER) -> Message:
+    """
+    Turns the `placeholder` message (the "loading" message) into the reply, instead of
+    sending the reply as new messages. Replies too long for one message continue in new
+    messages, and `reply_markup` goes on the last one. Returns the last message.
+    """
+    parts = split_reply(text, markdown=markdown) or [text]
+    if markdown:
+        parts = [escape_markdown(part) for part in parts]
+    parse_mode = ParseMode.MARKDOWN if markdown else None
+
+    message = None
+    if placeholder is not None:
+        try:
+            message = await bot.edit_message_text(
+                parts[0], chat_id=chat_id, message_id=placeholder.message_id, parse_mode=parse_mode,
+                reply_markup=reply_markup if len(parts) == 1 else None, rate_limit_args=rate_limit_args)
+        except BadRequest as e:
+            if "not modified" in e.message:
+                message = placeholder
+            else:
+                # Deleted by the user or too old to edit: fall back to a new message
+                logger.warning({"id": chat_id, "category": "reply_renderer", "label": "edit_failed", "error": e.message})
+        if message is not None:
+            parts = parts[1:]
+
+    for index, part in enumerate(parts):
+        message = await bot.send_message(
+            chat_id=chat_id, text=part, parse_mode=parse_mode,
+            reply_markup=reply_markup if index == len(parts) - 1 else None, rate_limit_args=rate_limit_args)
+    return message
+
+
+class StreamingReply:
+    """
+    Shows an answer in the `placeholder` message while it is still being generated.
+
+    `update` only records the latest text. A background task edits the placeholder to
+    it at most once every `interval`, as plain text with a trailing ellipsis, so that a
+    half-received Markdown entity cannot make the edit fail. Once the answer is
+    complete, `close` stops the edits and `render_reply` writes the final reply.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, placeholder: Message, interval=stream_edit_interval):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.placeholder = placeholder
+        self.interval = interval
+        self.text = ""
+        self.edits = 0
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def update(self, text: str):
+        if self._closed:
+            # A shared backend call can keep streaming after this reply's handler has finished
+            return
+        self.text = text
+        if self._task is None:
+            self._task = asyncio.create_task(self._edit_loop())
+
+    async def _edit_loop(self):
+        shown = ""
+        while True:
+            text = self.text
+            if text != shown:
+                preview = split_reply(text, markdown=False, limit=MessageLimit.MAX_TEXT_LENGTH - 1)[0] + "…"
+                try:
+                    await self.bot.edit_message_text(preview, chat_id=self.chat_id, message_id=self.placeholder.message_id,
+                                                     rate_limit_args=PRIORITY_NORMAL)
+                except TelegramError as e:
+                    # The final reply is still rendered, just without the preview
+                    logger.warning({"id": self.chat_id, "category": "reply_renderer", "label": "stream_edit_failed",
+                                    "error": str(e)})
+                    return
+                shown = text
+                self.edits += 1
+            await asyncio.sleep(self.interval)
+
+    async def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,319 @@
+import asyncio
+import bisect
+import itertools
+import os
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional
+
+from redis.exceptions import RedisError
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from logger import logger
+from metrics import TELEGRAM_API_LATENCY
+from redis_util import get_redis
+
+send_global_rate = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+send_global_burst = float(os.getenv('SEND_GLOBAL_BURST', '30'))
+send_chat_rate = float(os.getenv('SEND_CHAT_RATE', '1'))
+send_chat_burst = float(os.getenv('SEND_CHAT_BURST', '3'))
+send_group_rate = float(os.getenv('SEND_GROUP_RATE', str(20 / 60)))
+send_max_retries = int(os.getenv('SEND_MAX_RETRIES', '3'))
+
+_REDIS_ERRORS = (RedisError, OSError, asyncio.TimeoutError)
+# Seconds a worker uses its local share of the limits after Redis failed, before trying Redis again
+SHARED_RETRY_INTERVAL = 5.0
+
+# Takes a token from the global and the chat bucket at once, or returns the milliseconds to
+# wait as {global delay, chat delay}. KEYS: global bucket, chat bucket, pause key.
+# ARGV: global rate, global burst, chat rate, chat burst. Times come from the Redis clock.
+_TAKE_SCRIPT = """
+local paused = redis.call('PTTL', KEYS[3])
+if paused > 0 then return {paused, 0} end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local function level(key, rate, burst)
+    local state = redis.call('HMGET', key, 'tokens', 'at')
+    if not state[1] then return burst end
+    return math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate / 1000)
+end
+local global_rate, global_burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local chat_rate, chat_burst = tonumber(ARGV[3]), tonumber(ARGV[4])
+local global_tokens = level(KEYS[1], global_rate, global_burst)
+if global_tokens < 1 then return {math.ceil((1 - global_tokens) * 1000 / global_rate), 0} end
+local chat_tokens = level(KEYS[2], chat_rate, chat_burst)
+if chat_tokens < 1 then return {0, math.ceil((1 - chat_tokens) * 1000 / chat_rate)} end
+redis.call('HSET', KEYS[1], 'tokens', tostring(global_tokens - 1), 'at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(global_burst * 1000 / global_rate) + 1000)
+redis.call('HSET', KEYS[2], 'tokens', tostring(chat_tokens - 1), 'at', now)
+redis.call('PEXPIRE', KEYS[2], math.ceil(chat_burst * 1000 / chat_rate) + 1000)
+return {0, 0}
+"""
+
+# Pauses every worker's sends for ARGV[1] milliseconds, unless a longer pause is already set
+_PAUSE_SCRIPT = """
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], '1', 'PX', ARGV[1])
+end
+"""
+
+# Passed as `rate_limit_args` to bot methods, lower goes first
+PRIORITY_ANSWER = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class SendScheduler(BaseRateLimiter[int]):
+    """
+    Rate limiter for every outbound Bot API call that targets a chat.
+
+    A request waits for a token from the global bucket and from its chat's bucket (group
+    chats get Telegram's stricter group rate). Waiting requests are granted in priority
+    order, so answers go out before feedback prompts and menus when the bot is at its
+    global limit, and a chat out of tokens never holds up other chats. A 429 pauses all
+    sends for the `retry_after` Telegram asks for before the request is retried.
+
+    Telegram's limits are per bot, so with `workers` above one the buckets and the pause
+    are kept in Redis under `namespace` and shared by every worker, each grant taking
+    a token from both buckets in one script call. If Redis cannot be reached, each worker
+    falls back to local buckets with its share, 1/`workers`, of the rates.
+    """
+
+    def __init__(self, global_rate=send_global_rate, global_burst=send_global_burst, chat_rate=send_chat_rate,
+                 chat_burst=send_chat_burst, group_rate=send_group_rate, max_retries=send_max_retries,
+                 namespace: str = "", workers=1):
+        self.namespace = namespace
+        self.shared = workers > 1
+        self.workers = workers
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.requests = 0
+        self.throttled = 0
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._waiters: List[list] = []  # sorted [priority, seq, chat_id, future]
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        # chat_id -> when its shared bucket has a token again, to skip asking Redis before that
+        self._not_before: Dict[Any, float] = {}
+        self.redis_errors = 0
+        self._local_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        share = self.workers if self.shared else 1
+        self._global = TokenBucket(self.global_rate / share, self.global_burst / share)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                now = time.monotonic()
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full(now)}
+            share = self.workers if self.shared else 1
+            rate, burst = self._chat_limits(chat_id)
+            bucket = TokenBucket(rate / share, max(1, burst / share))
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _chat_limits(self, chat_id) -> tuple:
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        return (self.group_rate, 1) if is_group else (self.chat_rate, self.chat_burst)
+
+    async def _sleep(self, timeout: float):
+        """Sleeps for `timeout`, or until a new request is queued."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _dispatch(self):
+        while True:
+            if not self._waiters:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self.shared and now >= self._local_until:
+                delay = await self._grant_shared(now)
+            else:
+                delay = self._grant_local(now)
+            if delay is not None:
+                await self._sleep(delay)
+
+    def _grant_local(self, now: float) -> Optional[float]:
+        """Grants the first waiter whose chat has a token, or returns the seconds until one might."""
+        global_delay = self._global.delay(now)
+        if global_delay > 0:
+            return global_delay
+        soonest = None
+        for index, (_, _, chat_id, future) in enumerate(self._waiters):
+            if future.done():  # the caller was cancelled
+                del self._waiters[index]
+                return None
+            bucket = self._chat_bucket(chat_id)
+            delay = bucket.delay(now)
+            if delay <= 0:
+                del self._waiters[index]
+                self._global.take()
+                bucket.take()
+                future.set_result(None)
+                return None
+            soonest = delay if soonest is None else min(soonest, delay)
+        return soonest
+
+    async def _grant_shared(self, now: float) -> Optional[float]:
+        """Like `_grant_local`, with the tokens taken from the buckets all workers share in Redis."""
+        soonest = None
+        # Waiters can be queued during the Redis round trips, so the loop walks a copy and removes
+        # the waiter it grants by value, never by a position that may have shifted
+        for waiter in list(self._waiters):
+            chat_id, future = waiter[2], waiter[3]
+            if future.done():
+                self._waiters.remove(waiter)
+                return None
+            not_before = self._not_before.get(chat_id, 0.0)
+            if not_before > now:
+                soonest = not_before - now if soonest is None else min(soonest, not_before - now)
+                continue
+            chat_rate, chat_burst = self._chat_limits(chat_id)
+            try:
+                global_ms, chat_ms = await get_redis().eval(
+                    _TAKE_SCRIPT, 3, f"{self.namespace}_send_global", f"{self.namespace}_send_chat_{chat_id}",
+                    f"{self.namespace}_send_paused", self.global_rate, self.global_burst, chat_rate, chat_burst)
+            except _REDIS_ERRORS as e:
+                self.redis_errors += 1
+                if self.redis_errors % 100 == 1:
+                    logger.error({"category": "send_scheduler", "label": "shared_limits_unavailable",
+                                  "error": str(e), "errors": self.redis_errors})
+                self._local_until = time.monotonic() + SHARED_RETRY_INTERVAL
+                return None
+            if global_ms > 0:
+                # The global bucket, or a pause after a 429 in any worker
+                return global_ms / 1000
+            if chat_ms > 0:
+                if len(self._not_before) > 10000:
+                    self._not_before = {key: value for key, value in self._not_before.items() if value > now}
+                self._not_before[chat_id] = now + chat_ms / 1000
+                soonest = chat_ms / 1000 if soonest is None else min(soonest, chat_ms / 1000)
+                continue
+            self._waiters.remove(waiter)
+            # A caller cancelled during the round trip leaves its token spent, which only errs on the safe side
+            if not future.done():
+                future.set_result(None)
+            return None
+        return soonest
+
+    async def _pause_shared(self, seconds: float):
+        if time.monotonic() < self._local_until:
+            return
+        try:
+            await get_redis().eval(_PAUSE_SCRIPT, 1, f"{self.namespace}_send_paused", int(seconds * 1000))
+        except _REDIS_ERRORS as e:
+            logger.error({"category": "send_scheduler", "label": "pause_not_shared", "error": str(e)})
+
+    async def _acquire(self, chat_id, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiters, [priority, next(self._seq), chat_id, future])
+        self._wakeup.set()
+        await future
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # getFile, answerCallbackQuery, setWebhook, ... are not subject to the flood limits
+            return await self._call(endpoint, callback, args, kwargs)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        priority = PRIORITY_NORMAL if rate_limit_args is None else rate_limit_args
+        self.requests += 1
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                return await self._call(endpoint, callback, args, kwargs)
+            except RetryAfter as exc:
+                self.throttled += 1
+                if attempt == self.max_retries:
+                    logger.error({"category": "send_scheduler", "label": "retries_exhausted", "endpoint": endpoint,
+                                  "id": chat_id, "retry_after": str(exc.retry_after)})
+                    raise
+                retry_after = exc.retry_after
+                seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + seconds + 0.1)
+                if self.shared:
+                    await self._pause_shared(seconds + 0.1)
+                logger.warning({"category": "send_scheduler", "label": "retry_after", "endpoint": endpoint,
+                                "id": chat_id, "retry_after": seconds})
+
+    @staticmethod
+    async def _call(endpoint: str, callback, args, kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = await callback(*args, **kwargs)
+            status = "ok"
+            return result
+        except RetryAfter:
+            status = "retry_after"
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.labels(endpoint, status).observe(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "throttled": self.throttled, "queued": self.queued(),
+                "shared": self.shared, "redis_errors": self.redis_errors}
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import os
+import uuid
+from typing import Awaitable, Callable, Dict
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from redis_util import get_redis
+
+single_flight_distributed = os.getenv('SINGLE_FLIGHT_DISTRIBUTED', 'false').lower() == 'true'
+single_flight_lock_ttl = float(os.getenv('SINGLE_FLIGHT_LOCK_TTL', '120'))
+single_flight_result_ttl = float(os.getenv('SINGLE_FLIGHT_RESULT_TTL', '30'))
+single_flight_poll_interval = float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', '0.25'))
+
+_REDIS_ERRORS = (RedisError, OSError, asyncio.TimeoutError)
+
+# Deletes the lock only while this process still holds it, not after it expired and another worker took it
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent backend requests into one call.
+
+    Callers asking for a key that is already in flight in this process wait on the same
+    task and all get its result. With `distributed` set, the first worker to take a Redis
+    lock for the key makes the call and publishes a successful response under a short
+    lived result key, which the other workers poll for instead of calling the backend.
+    """
+
+    def __init__(self, namespace="single_flight", distributed=single_flight_distributed,
+                 lock_ttl=single_flight_lock_ttl, result_ttl=single_flight_result_ttl,
+                 poll_interval=single_flight_poll_interval):
+        self.namespace = namespace
+        self.distributed = distributed
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.coalesced = 0
+        self.remote_coalesced = 0
+        self._origin = uuid.uuid4().hex
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[dict]]) -> dict:
+        """Returns the result of `fn()`, sharing one call among concurrent callers of `key`."""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            # A task of its own, so that a caller going away does not cancel the call for the others
+            task = asyncio.ensure_future(self._run(key, fn))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here so it is never reported as unhandled
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable[dict]]) -> dict:
+        if not self.distributed:
+            return await fn()
+
+        lock_key = f"{self.namespace}_lock_{key}"
+        result_key = f"{self.namespace}_result_{key}"
+        redis = get_redis()
+        try:
+            leader = await redis.set(lock_key, self._origin, nx=True, px=int(self.lock_ttl * 1000))
+        except _REDIS_ERRORS as e:
+            logger.error({"category": "single_flight", "label": "lock_failed", "error": str(e)})
+            return await fn()
+
+        if leader:
+            try:
+                result = await fn()
+                if "error" not in result:
+                    try:
+                        await redis.set(result_key, json.dumps(result), px=int(self.result_ttl * 1000))
+                    except _REDIS_ERRORS as e:
+                        logger.error({"category": "single_flight", "label": "publish_failed", "error": str(e)})
+                return result
+            finally:
+                try:
+                    await redis.eval(_RELEASE_SCRIPT, 1, lock_key, self._origin)
+                except _REDIS_ERRORS:
+                    pass
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_ttl
+        try:
+            while loop.time() < deadline:
+                # The lock is checked before the result: the leader publishes before unlocking
+                async with redis.pipeline(transaction=False) as pipe:
+                    pipe.exists(lock_key)
+                    pipe.get(result_key)
+                    locked, payload = await pipe.execute()
+                if payload is not None:
+                    self.remote_coalesced += 1
+                    return json.loads(payload)
+                if not locked:
+                    break
+                await asyncio.sleep(self.poll_interval)
+        except _REDIS_ERRORS as e:
+            logger.error({"category": "single_flight", "label": "poll_failed", "error": str(e)})
+        # The leader failed, or gave up: make the call ourselves
+        return await fn()
+
+    def stats(self) -> dict:
+        return {"inflight": len(self._inflight), "coalesced": self.coalesced, "remote_coalesced": self.remote_coalesced}
+
+
+single_flight = SingleFlight()
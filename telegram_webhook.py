@@ -11,21 +11,25 @@ just as well.
 Usage:
 Set bot Token, URL, admin CHAT_ID and PORT after the imports.
 You may also need to change the `listen` value in the uvicorn configuration to match your setup.
+Set UVICORN_WORKERS to the number of worker processes serving the webhook port.
 Press Ctrl-C on the command line or send a signal to the process to stop the bot.
 """
 import asyncio
-import json
+import hmac
 import os
-import redis
+import shutil
+import time
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Union, TypedDict
-import requests
+from typing import Callable, Optional, Union, TypedDict
+import httpx
 import uvicorn
+from prometheus_client import CONTENT_TYPE_LATEST
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import PlainTextResponse, Response
+from starlette.responses import JSONResponse, PlainTextResponse, Response
 from starlette.routing import Route
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram import __version__ as TG_VER
 from telegram.ext import (
     Application,
@@ -35,17 +39,38 @@ from telegram.ext import (
     ExtBot,
     CallbackQueryHandler, MessageHandler,
 )
-from typing import List, Dict
-from language_util import language_init, get_languages, get_message
+from language_util import language_init, get_message, get_language_keyboard, get_context_keyboard
 from telegram.ext import filters
-from config_util import get_config_value
-from logger import logger
+from chat_lanes import ChatLaneUpdateProcessor
+from config_reload import ConfigReloader
+from config_util import get_settings
+from drain import DrainController
+from logger import logger, NonBlockingQueueHandler
+from metrics import (BACKEND_LATENCY, MetricsSampler, prepare_multiprocess_dir, render, sample_metrics,
+                     sampled_counter, sampled_gauge, timed_handler)
 from telemetry_logger import TelemetryLogger
-from telegram.helpers import escape_markdown
+from answer_cache import answer_cache, query_fingerprint
+from answer_stream import backend_streaming, stream_answer
+from backend_guard import BackendUnavailable, get_backend_guard, backend_guard_stats
+from backend_pool import DeadlineExceeded, backend_pool_stats, get_backend_pool
+from audio_relay import send_audio, AudioRelayError
+from http_client import backend_total_timeout, post_json, close_http_clients
+from preference_store import preference_store
+from redis_persistence import RedisPersistence
+from redis_util import close_redis
+from reply_renderer import render_reply, StreamingReply
+from send_scheduler import SendScheduler, PRIORITY_ANSWER, PRIORITY_LOW
+from single_flight import single_flight
+from update_dedup import UpdateDeduplicator
+from update_poller import UpdatePoller
+from voice_file_cache import voice_file_cache
+from webhook_ingestion import UpdateIngestor, UpdateQueue, webhook_secret_token
 telemetryLogger = TelemetryLogger()
 # Define configuration constants
 TELEGRAM_BASE_URL = os.environ["TELEGRAM_BASE_URL"]
 TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
+# Points the bot at a local Bot API server, or at the stand-in used by the benchmark
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org').rstrip('/')
 botName = os.environ['TELEGRAM_BOT_NAME']
 concurrent_updates = int(os.getenv('concurrent_updates', '256'))
 pool_time_out = int(os.getenv('pool_timeout', '30'))
@@ -53,12 +78,14 @@ connection_pool_size = int(os.getenv('connection_pool_size', '1024'))
 connect_time_out = int(os.getenv('connect_timeout', '300'))
 read_time_out = int(os.getenv('read_timeout', '15'))
 write_time_out = int(os.getenv('write_timeout', '10'))
-workers = int(os.getenv("UVICORN_WORKERS", "4"))
-redis_host = os.getenv("REDIS_HOST", "172.17.0.1")
-redis_port = int(os.getenv("REDIS_PORT", "6379"))
-redis_index = int(os.getenv("REDIS_INDEX", "1"))
-DEFAULT_CONTEXT = get_config_value('default', 'context', None)
-DEFAULT_LANGUAGE = get_config_value('default', 'language', None)
+# webhook, or polling where Telegram cannot reach the bot
+TELEGRAM_TRANSPORT = os.getenv('TELEGRAM_TRANSPORT', 'webhook').lower()
+# Only one process may call getUpdates for a bot, so polling always runs a single worker
+workers = 1 if TELEGRAM_TRANSPORT == "polling" else int(os.getenv("UVICORN_WORKERS", "4"))
+# Bearer token for the /admin endpoints, which are disabled while it is unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+# Seconds an update may take from the start of its handler, backend calls included
+update_deadline = float(os.getenv('UPDATE_DEADLINE', '90'))
 try:
     from telegram import __version_info__
 except ImportError:
@@ -71,20 +98,6 @@ if __version_info__ < (20, 0, 0, "alpha", 1):
         f"visit https://docs.python-telegram-bot.org/en/v{TG_VER}/examples.html"
     )
 
-# Connect to Redis
-redis_client = redis.Redis(host=redis_host, port=redis_port, db=redis_index)  # Adjust host and port if needed
-
-
-# Define a function to store and retrieve data in Redis
-def store_data(key, value):
-    redis_client.set(key, value)
-
-
-def retrieve_data(key):
-    data_from_redis = redis_client.get(key)
-    return data_from_redis.decode('utf-8') if data_from_redis is not None else None
-
-
 @dataclass
 class WebhookUpdate:
     """Simple dataclass to wrap a custom update type"""
@@ -105,8 +118,12 @@ class CustomContext(CallbackContext[ExtBot, dict, dict, dict]):
             application: "Application",
     ) -> "CustomContext":
         if isinstance(update, WebhookUpdate):
-            return cls(application=application, user_id=update.user_id)
-        return super().from_update(update, application)
+            context = cls(application=application, user_id=update.user_id)
+        else:
+            context = super().from_update(update, application)
+        # On the time.monotonic clock; backend calls made for the update stop when it runs out
+        context.deadline = time.monotonic() + update_deadline
+        return context
 
 
 class ApiResponse(TypedDict):
@@ -114,25 +131,17 @@ class ApiResponse(TypedDict):
 
 
 class ApiError(TypedDict):
-    error: Union[str, requests.exceptions.RequestException]
+    error: Union[str, httpx.HTTPError]
 
 
-def get_user_langauge(update: Update, default_lang=DEFAULT_LANGUAGE) -> str:
-    user_id_lan = str(update.effective_chat.id) + '_language'
-    selected_lang = retrieve_data(user_id_lan)
-    if selected_lang:
-        return selected_lang
-    else:
-        return default_lang
+async def get_user_langauge(update: Update, default_lang=None) -> str:
+    preferences = await preference_store.get(update.effective_chat.id)
+    return preferences.language or default_lang or get_settings().default.language
 
 
-def get_user_context(update: Update, default_context=DEFAULT_CONTEXT) -> str:
-    user_context_id = str(update.effective_chat.id) + '_context'
-    selected_context = retrieve_data(user_context_id)
-    if selected_context:
-        return selected_context
-    else:
-        return default_context
+async def get_user_context(update: Update, default_context=None) -> str:
+    preferences = await preference_store.get(update.effective_chat.id)
+    return preferences.context or default_context or get_settings().default.context
 
 
 async def send_message_to_bot(chat_id, text, context: CustomContext, parse_mode="Markdown") -> None:
@@ -144,28 +153,15 @@ async def start(update: Update, context: CustomContext) -> None:
     """Send a message when the command /start is issued."""
     user_name = update.message.chat.first_name
     logger.info({"id": update.effective_chat.id, "username": user_name, "category": "logged_in", "label": "logged_in"})
-    await send_message_to_bot(update.effective_chat.id, get_config_value('default', 'welcome_msg', None), context)
+    await send_message_to_bot(update.effective_chat.id, get_settings().default.welcome_msg, context)
     await language_handler(update, context)
 
 
-def create_language_keyboard():
-    """Creates an inline keyboard markup with buttons for supported languages."""
-    inline_keyboard_buttons = []
-    languages = get_languages()
-    for language in languages:
-        button = InlineKeyboardButton(
-            text=language["text"], callback_data=f"lang_{language['code']}"
-        )
-        inline_keyboard_buttons.append([button])
-            
-    return inline_keyboard_buttons
-
-
 async def language_handler(update: Update, context: CustomContext):
-    inline_keyboard_buttons = create_language_keyboard()
-    if inline_keyboard_buttons:
-        reply_markup = InlineKeyboardMarkup(inline_keyboard_buttons)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="\nPlease select a Language to proceed", reply_markup=reply_markup)
+    reply_markup = get_language_keyboard()
+    if reply_markup:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="\nPlease select a Language to proceed", reply_markup=reply_markup,
+                                       rate_limit_args=PRIORITY_LOW)
     else:
         return query_handler
 
@@ -174,8 +170,7 @@ async def preferred_language_callback(update: Update, context: CustomContext):
     callback_query = update.callback_query
     preferred_language = callback_query.data[len("lang_"):]
     context.user_data['language'] = preferred_language
-    user_id_lan = str(update.effective_chat.id) + '_language'
-    store_data(user_id_lan, preferred_language)
+    await preference_store.set(update.effective_chat.id, language=preferred_language)
     logger.info(
         {"id": update.effective_chat.id, "username": update.effective_chat.first_name, "category": "language_selection",
          "label": "engine_selection", "value": preferred_language})
@@ -183,31 +178,22 @@ async def preferred_language_callback(update: Update, context: CustomContext):
     await context_handler(update, context)
     # return query_handler
 
-def create_context_keyboard_buttons(contexts: List[dict]):
-    inline_keyboard_buttons = []
-    for context in contexts:
-        inline_keyboard_buttons.append(
-        [InlineKeyboardButton(context["label"], callback_data=f'contextname_{context["value"]}')])
-    return InlineKeyboardMarkup(inline_keyboard_buttons)
-
 async def context_handler(update: Update, context: CustomContext):
-    selected_language = get_user_langauge(update)
-    context_options = get_message(language=selected_language, key="context")
+    selected_language = await get_user_langauge(update)
     text_message = get_message(language=selected_language, key="default_context_selection")
-    reply_markup = None
-    if context_options:
-        reply_markup = create_context_keyboard_buttons(context_options)
+    reply_markup = get_context_keyboard(selected_language)
+    if reply_markup:
         text_message = get_message(language=selected_language, key="language_selection")
     
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_message, reply_markup=reply_markup, parse_mode="Markdown") 
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_message, reply_markup=reply_markup, parse_mode="Markdown",
+                                   rate_limit_args=PRIORITY_LOW)
         
 async def preferred_context_callback(update: Update, context: CustomContext):
     callback_query = update.callback_query
     preferred_context = callback_query.data[len("contextname_"):]
     context.user_data['contextname'] = preferred_context
-    user_context_id = str(update.effective_chat.id) + '_context'
-    store_data(user_context_id, preferred_context)
-    selected_language = get_user_langauge(update)
+    await preference_store.set(update.effective_chat.id, context=preferred_context)
+    selected_language = await get_user_langauge(update)
     text_msg = get_message(selected_language,"context_selection", preferred_context)
     logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name, "category": "context_selection", "label": "context_selection", "value": preferred_context})
     await callback_query.answer()
@@ -218,62 +204,115 @@ async def help_command(update: Update, context: CustomContext) -> None:
     """Send a message when the command /help is issued."""
     await update.message.reply_text("Help!")
 
-def get_bot_endpoint(contextName: str):
+def get_backend_name(contextName: str):
+    return "story" if contextName == "story" else "activity"
+
+
+def get_bot_path(contextName: str):
     if contextName == "story":
-        return os.environ["STORY_API_BASE_URL"] + '/v1/query_rstory'
+        return '/v1/query_rstory'
     else:
-        return os.environ["ACTIVITY_API_BASE_URL"]  + '/v1/chat'
+        return '/v1/chat'
+
+async def call_backend(backend: str, path: str, reqBody: dict, headers: dict, deadline: float,
+                       on_text: Optional[Callable[[str], None]] = None) -> Union[ApiResponse, ApiError]:
+    start = time.perf_counter()
+    status = "ok"
+
+    async def send(base_url: str, timeout: float):
+        timeout = min(timeout, backend_total_timeout)
+        if on_text is not None:
+            return await stream_answer(base_url + path, reqBody, headers, on_text, timeout=timeout)
+        response = await post_json(base_url + path, reqBody, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
 
-async def get_query_response(query: str, voice_message_url: str, update: Update, context: CustomContext) -> Union[
-    ApiResponse, ApiError]:
-    voice_message_language = get_user_langauge(update)
-    selected_context = get_user_context(update)
+    try:
+        # Each backend has its own concurrency limit and circuit breaker, so a slow
+        # story LLM cannot take the capacity teacher/parent queries need
+        async with get_backend_guard(backend).slot():
+            # A streamed answer is already on its way to the chat, so it is never hedged
+            return await get_backend_pool(backend).call(send, deadline, hedge=on_text is None)
+    except BackendUnavailable as e:
+        status = "unavailable"
+        return {'error': str(e)}
+    except DeadlineExceeded as e:
+        status = "deadline"
+        return {'error': str(e)}
+    except httpx.HTTPStatusError as e:
+        status = str(e.response.status_code)
+        return {'error': e}
+    except httpx.TimeoutException as e:
+        status = "timeout"
+        return {'error': e}
+    except httpx.HTTPError as e:
+        status = "error"
+        return {'error': e}
+    except (KeyError, ValueError):
+        status = "invalid_response"
+        return {'error': 'Invalid response received from API'}
+    finally:
+        BACKEND_LATENCY.labels(reqBody["input"]["context"], status).observe(time.perf_counter() - start)
+
+
+async def get_query_response(query: str, voice_message_url: str, update: Update, context: CustomContext,
+                             on_text: Optional[Callable[[str], None]] = None) -> Union[ApiResponse, ApiError]:
+    """Answers a query. With `on_text`, the backend is asked to stream and `on_text` gets the text so far."""
+    voice_message_language = await get_user_langauge(update)
+    selected_context = await get_user_context(update)
     context.user_data['language'] = voice_message_language
     context.user_data['contextname'] = selected_context
     logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name, "language_selected": voice_message_language, "bot_selected": selected_context})
     user_id = update.message.from_user.id
     message_id = update.message.message_id
-    url = get_bot_endpoint(selected_context)
-    try:
-        reqBody: dict
-        if voice_message_url is None:
-            reqBody = {
-                "input": {
-                    "language": voice_message_language,
-                    "text": query
-                },
-                "output": {
-                    'format': 'text'
-                }
+    path = get_bot_path(selected_context)
+    backend = get_backend_name(selected_context)
+    if voice_message_url is None:
+        cached_response = await answer_cache.get(selected_context, voice_message_language, query)
+        if cached_response is not None:
+            return cached_response
+    reqBody: dict
+    if voice_message_url is None:
+        reqBody = {
+            "input": {
+                "language": voice_message_language,
+                "text": query
+            },
+            "output": {
+                'format': 'text'
             }
-        else:
-            reqBody = {
-                "input": {
-                    "language": voice_message_language,
-                    "audio": voice_message_url
-                },
-                "output": {
-                    'format': 'audio'
-                }
+        }
+    else:
+        reqBody = {
+            "input": {
+                "language": voice_message_language,
+                "audio": voice_message_url
+            },
+            "output": {
+                'format': 'audio'
             }
-        reqBody["input"]["context"] = selected_context
-        logger.info(f" API Request Body: {reqBody}")
-        headers = {
-            "x-source": "telegram",
-            "x-request-id": str(message_id),
-            "x-device-id": f"d{user_id}",
-            "x-consumer-id": str(user_id)
         }
-        response = requests.post(url, data=json.dumps(reqBody), headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        requests.session().close()
-        response.close()
+    reqBody["input"]["context"] = selected_context
+    logger.info({"id": update.effective_chat.id, "category": "get_query_response", "label": "api_request_body",
+                 "value": reqBody})
+    headers = {
+        "x-source": "telegram",
+        "x-request-id": str(message_id),
+        "x-device-id": f"d{user_id}",
+        "x-consumer-id": str(user_id)
+    }
+    if voice_message_url is not None:
+        return await call_backend(backend, path, reqBody, headers, context.deadline, on_text)
+
+    async def fetch_answer():
+        # Only the caller that makes the call sees the stream, the others get the final answer
+        data = await call_backend(backend, path, reqBody, headers, context.deadline, on_text)
+        if "error" not in data:
+            await answer_cache.put(selected_context, voice_message_language, query, data)
         return data
-    except requests.exceptions.RequestException as e:
-        return {'error': e}
-    except (KeyError, ValueError):
-        return {'error': 'Invalid response received from API'}
+
+    # Identical text queries in flight at the same time share one backend call
+    return await single_flight.do(query_fingerprint(selected_context, voice_message_language, query), fetch_answer)
 
 
 async def response_handler(update: Update, context: CustomContext) -> None:
@@ -289,24 +328,37 @@ async def query_handler(update: Update, context: CustomContext):
     elif update.message.voice:
         voice_message = update.message.voice
 
+    selected_language = await get_user_langauge(update)
+    loading_msg = get_message(language=selected_language, key="context_loading_msg")
+    send_loading_message = context.bot.send_message(chat_id=update.effective_chat.id, text=loading_msg)
     voice_message_url = None
     if voice_message is not None:
-        voice_file = await voice_message.get_file()
-        voice_message_url = voice_file.file_path
+        # Resolving the voice note does not depend on the loading message, so both go out at once
+        voice_message_url, loading_message = await asyncio.gather(
+            voice_file_cache.get_file_url(context.bot, voice_message), send_loading_message)
         logger.info({"id": update.effective_chat.id, "username": update.effective_chat.first_name, "category": "query_handler", "label": "voice_question", "value": voice_message_url})
-    selected_language = get_user_langauge(update)
-    loading_msg = get_message(language=selected_language, key="context_loading_msg")
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=loading_msg)
-    await handle_query_response(update, context, query, voice_message_url)
+    else:
+        loading_message = await send_loading_message
+    await handle_query_response(update, context, query, voice_message_url, loading_message)
     return query_handler
 
 
-async def handle_query_response(update: Update, context: CustomContext, query: str, voice_message_url: str):
-    response = await get_query_response(query, voice_message_url, update, context)
+async def handle_query_response(update: Update, context: CustomContext, query: str, voice_message_url: str,
+                                loading_message: Message = None):
+    """Replies in place of the loading message, with the feedback buttons on the answer itself."""
+    streaming_reply = None
+    if backend_streaming and loading_message is not None:
+        streaming_reply = StreamingReply(context.bot, update.effective_chat.id, loading_message)
+    try:
+        response = await get_query_response(query, voice_message_url, update, context,
+                                            streaming_reply.update if streaming_reply else None)
+    finally:
+        if streaming_reply is not None:
+            await streaming_reply.close()
     if "error" in response:
-        selected_language = get_user_langauge(update)
+        selected_language = await get_user_langauge(update)
         error_msg = get_message(language=selected_language, key="context_error_msg")
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=error_msg)
+        await render_reply(context.bot, update.effective_chat.id, loading_message, error_msg)
         info_msg = {"id": update.effective_chat.id, "username": update.effective_chat.first_name,
                     "category": "handle_query_response", "label": "question_sent", "value": query}
         logger.info(info_msg)
@@ -323,20 +375,28 @@ async def handle_query_response(update: Update, context: CustomContext, query: s
              InlineKeyboardButton("👎🏻", callback_data=f'message-disliked__{update.message.id}')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=escape_markdown(answer), parse_mode="Markdown")
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="Please provide your feedback", parse_mode="Markdown", reply_markup=reply_markup)
-        if response['output']["audio"]:
+        await render_reply(context.bot, update.effective_chat.id, loading_message, answer, reply_markup=reply_markup,
+                           markdown=True)
+        voice_file_id = response.get("voice_file_id")
+        if voice_file_id:
+            await context.bot.send_voice(chat_id=update.effective_chat.id, voice=voice_file_id, rate_limit_args=PRIORITY_ANSWER)
+        elif response['output']["audio"]:
             audio_output_url = response['output']["audio"]
-            audio_request = requests.get(audio_output_url)
-            audio_data = audio_request.content
-            await context.bot.send_voice(chat_id=update.effective_chat.id, voice=audio_data)
+            try:
+                voice_message = await send_audio(context.bot, update.effective_chat.id, audio_output_url)
+                if query and voice_message.voice:
+                    await answer_cache.set_voice_file_id(context.user_data['contextname'], context.user_data['language'],
+                                                         query, voice_message.voice.file_id)
+            except (httpx.HTTPError, AudioRelayError) as e:
+                logger.error({"id": update.effective_chat.id, "category": "handle_query_response",
+                              "label": "audio_failed", "value": audio_output_url, "error": str(e)})
 
 
 async def preferred_feedback_callback(update: Update, context: CustomContext) -> None:
-    """Parses the CallbackQuery and updates the message text."""
+    """Parses the CallbackQuery and marks the selected button, leaving the answer it is attached to as is."""
     query = update.callback_query
     queryData = query.data.split("__")
-    selected_context = get_user_context(update)
+    selected_context = await get_user_context(update)
     user_id = update.callback_query.from_user.id
     eventData = {
         "x-source": "telegram",
@@ -359,7 +419,7 @@ async def preferred_feedback_callback(update: Update, context: CustomContext) ->
          InlineKeyboardButton(thumpDownIcon, callback_data='replymessage_disliked')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Please provide your feedback:", reply_markup=reply_markup)
+    await query.edit_message_reply_markup(reply_markup=reply_markup)
 
 
 async def preferred_feedback_reply_callback(update: Update, context: CustomContext) -> None:
@@ -370,69 +430,264 @@ async def preferred_feedback_reply_callback(update: Update, context: CustomConte
     await query.answer()
 
 
-async def main() -> None:
-    """Set up PTB application and a web application for handling the incoming requests."""
-    logger.info('################################################')
-    logger.info('# Telegram bot name %s', botName)
-    logger.info('################################################')
-    language_init()
+def build_application() -> Application:
+    """Builds the PTB application with all handlers registered. Each worker process builds its own."""
     context_types = ContextTypes(context=CustomContext)
     # Here we set updater to None because we want our custom webhook server to handle the updates.persistence(persistence)
     # and hence we don't need an Updater instance
+    # user_data, chat_data and bot_data are kept in Redis under the bot id, like the dedup keys
+    persistence = RedisPersistence(namespace=TELEGRAM_BOT_TOKEN.split(":")[0])
     application = (
-        Application.builder().token(TELEGRAM_BOT_TOKEN).updater(None).context_types(context_types).pool_timeout(pool_time_out).connection_pool_size(connection_pool_size).concurrent_updates(True).concurrent_updates(concurrent_updates).connect_timeout(
+        Application.builder().token(TELEGRAM_BOT_TOKEN).persistence(persistence).base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot").updater(None).update_queue(UpdateQueue()).rate_limiter(SendScheduler(namespace=TELEGRAM_BOT_TOKEN.split(":")[0], workers=workers)).context_types(context_types).pool_timeout(pool_time_out).connection_pool_size(connection_pool_size).concurrent_updates(ChatLaneUpdateProcessor(concurrent_updates, namespace=TELEGRAM_BOT_TOKEN.split(":")[0], shared=workers > 1)).connect_timeout(
             connect_time_out).read_timeout(read_time_out).write_timeout(write_time_out).build()
     )
 
     # register handlers
-    application.add_handler(CommandHandler("start", start, block=False))
-    application.add_handler(CommandHandler("help", help_command, block=False))
-    application.add_handler(CommandHandler('select_language', language_handler, block=False))
-    application.add_handler(CommandHandler('select_context', context_handler, block=False))
-    application.add_handler(CallbackQueryHandler(preferred_language_callback, pattern=r'lang_\w*', block=False))
-    application.add_handler(CallbackQueryHandler(preferred_context_callback, pattern=r'contextname_\w*', block=False))
-    application.add_handler(CallbackQueryHandler(preferred_feedback_callback, pattern=r'message-\w*', block=False))
-    application.add_handler(CallbackQueryHandler(preferred_feedback_reply_callback, pattern=r'replymessage_\w*', block=False))
-    application.add_handler(MessageHandler(filters.TEXT | filters.VOICE, response_handler, block=False))
-
-    # Pass webhook settings to telegram
-    await application.bot.set_webhook(url=f"{TELEGRAM_BASE_URL}/telegram", allowed_updates=Update.ALL_TYPES)
-
-    # Set up webserver
-    async def telegram(request: Request) -> Response:
-        """Handle incoming Telegram updates by putting them into the `update_queue`"""
-        body = await request.json()
-        await application.update_queue.put(
-            Update.de_json(data=body, bot=application.bot)
-        )
-        return Response()
+    application.add_handler(CommandHandler("start", timed_handler(start)))
+    application.add_handler(CommandHandler("help", timed_handler(help_command)))
+    application.add_handler(CommandHandler('select_language', timed_handler(language_handler)))
+    application.add_handler(CommandHandler('select_context', timed_handler(context_handler)))
+    application.add_handler(CallbackQueryHandler(timed_handler(preferred_language_callback), pattern=r'lang_\w*'))
+    application.add_handler(CallbackQueryHandler(timed_handler(preferred_context_callback), pattern=r'contextname_\w*'))
+    application.add_handler(CallbackQueryHandler(timed_handler(preferred_feedback_callback), pattern=r'message-\w*'))
+    application.add_handler(CallbackQueryHandler(timed_handler(preferred_feedback_reply_callback), pattern=r'replymessage_\w*'))
+    application.add_handler(MessageHandler(filters.TEXT | filters.VOICE, timed_handler(response_handler)))
+    return application
+
+
+async def set_webhook() -> None:
+    """Pass webhook settings to telegram. Runs once in the supervisor, not in every worker."""
+    async with Bot(TELEGRAM_BOT_TOKEN, base_url=f"{TELEGRAM_API_BASE_URL}/bot") as bot:
+        await bot.set_webhook(url=f"{TELEGRAM_BASE_URL}/telegram", allowed_updates=Update.ALL_TYPES,
+                              secret_token=webhook_secret_token or None)
+
+
+def register_metrics(application: Application, ingestor: Union[UpdateIngestor, UpdatePoller],
+                     drain_controller: DrainController) -> None:
+    """Exposes the counts the worker's components already keep, copied into metrics by the sampler."""
+    update_queue = application.update_queue
+    sampled_gauge("update_queue_depth", "Updates waiting in the update queue",
+                  function=lambda: {(): update_queue.qsize()})
+    sampled_gauge("update_backlog", "Updates accepted but not yet processed",
+                  function=lambda: {(): update_queue.backlog})
+    if isinstance(ingestor, UpdatePoller):
+        sampled_counter("polled_updates", "Updates fetched with getUpdates by outcome, and failed polls", ("outcome",),
+                        function=lambda: {(outcome,): value for outcome, value in ingestor.stats().items()
+                                          if outcome in ("accepted", "duplicates", "errors")})
+    else:
+        sampled_counter("webhook_updates", "Webhook posts by outcome", ("outcome",), function=lambda: {
+            (outcome,): value for outcome, value in ingestor.stats().items()
+            if outcome in ("accepted", "shed", "rejected", "refused_draining", "duplicates")})
+    sampled_gauge("worker_draining", "Workers taking no new updates while they finish their backlog",
+                  function=lambda: {(): int(drain_controller.draining)})
+    update_processor = application.update_processor
+    sampled_gauge("updates_running", "Updates being handled, at most concurrent_updates per worker",
+                  function=lambda: {(): update_processor.running})
+    sampled_gauge("chat_lanes", "Chats with updates being handled or waiting for their turn",
+                  function=lambda: {(): update_processor.stats()["chats"]})
+    sampled_counter("chat_lane_dropped", "Updates dropped because their chat had CHAT_LANE_MAX_PENDING outstanding",
+                    function=lambda: {(): update_processor.dropped})
+    sampled_gauge("telegram_send_queue", "Bot API calls waiting for the send scheduler",
+                  function=lambda: {(): application.bot.rate_limiter.queued()})
+    sampled_gauge("telemetry_queue_size", "Telemetry events waiting to be sent",
+                  function=lambda: {(): telemetryLogger.pending_events()})
+    sampled_counter("telemetry_events_dropped", "Telemetry events dropped on a full queue",
+                    function=lambda: {(): telemetryLogger.dropped_events})
+    sampled_counter("log_records_dropped", "Log records below WARNING dropped on a full log queue",
+                    function=lambda: {(): NonBlockingQueueHandler.dropped})
+    sampled_gauge("sakhi_backend_concurrency_limit", "Adaptive concurrency limit per backend, summed over the workers",
+                  ("backend",),
+                  function=lambda: {(name,): guard["limit"] for name, guard in backend_guard_stats().items()})
+    sampled_gauge("sakhi_backend_in_flight", "Calls in flight per backend", ("backend",),
+                  function=lambda: {(name,): guard["in_flight"] for name, guard in backend_guard_stats().items()})
+    sampled_gauge("sakhi_backend_circuit_open", "Workers whose circuit breaker for a backend is not closed",
+                  ("backend",), function=lambda: {(name,): int(guard["breaker"] != "closed")
+                                                  for name, guard in backend_guard_stats().items()})
+    sampled_gauge("sakhi_backend_replica_in_flight", "Calls in flight per backend replica", ("backend", "replica"),
+                  function=lambda: {(name, url): replica["in_flight"] for name, pool in backend_pool_stats().items()
+                                    for url, replica in pool["replicas"].items()})
+    sampled_counter("sakhi_backend_hedges", "Calls sent again to a second replica, and those the second replica won",
+                    ("backend", "outcome"), function=lambda: {
+                        (name, outcome): pool[key] for name, pool in backend_pool_stats().items()
+                        for outcome, key in (("sent", "hedges"), ("won", "hedges_won"))})
+
+
+@asynccontextmanager
+async def lifespan(starlette_app: Starlette):
+    """Runs the PTB application, and the pools it uses, for as long as this worker serves requests."""
+    language_init()
+    application = build_application()
+    starlette_app.state.application = application
+    # update_ids are only unique per bot, so the bot id namespaces the dedup keys
+    bot_id = TELEGRAM_BOT_TOKEN.split(":")[0]
+    deduplicator = UpdateDeduplicator(namespace=bot_id)
+    poller = None
+    if TELEGRAM_TRANSPORT == "polling":
+        # Polled updates go through the same update queue, handlers and pools as webhook posts
+        starlette_app.state.ingestor = poller = UpdatePoller(application, deduplicator=deduplicator)
+    else:
+        starlette_app.state.ingestor = UpdateIngestor(application, deduplicator=deduplicator)
+    starlette_app.state.drain = DrainController(application, starlette_app.state.ingestor, namespace=bot_id)
+    register_metrics(application, starlette_app.state.ingestor, starlette_app.state.drain)
+    starlette_app.state.metrics_sampler = MetricsSampler()
+    starlette_app.state.config_reloader = ConfigReloader(namespace=bot_id)
+    async with application:
+        await preference_store.start()
+        await telemetryLogger.start()
+        await application.start()
+        if poller is not None:
+            await poller.start()
+        await starlette_app.state.metrics_sampler.start()
+        await starlette_app.state.config_reloader.start()
+        await starlette_app.state.drain.start()
+        logger.info({"category": "worker", "label": "started", "pid": os.getpid(), "transport": TELEGRAM_TRANSPORT})
+        yield
+        # Handle every accepted update before the application stops, it drops what is still queued
+        await starlette_app.state.drain.shutdown()
+        await starlette_app.state.drain.stop()
+        await starlette_app.state.config_reloader.stop()
+        await starlette_app.state.metrics_sampler.stop()
+        if poller is not None:
+            await poller.stop()
+        await application.stop()
+        await telemetryLogger.stop()
+        await preference_store.stop()
+    await close_http_clients()
+    await close_redis()
+
+
+async def telegram(request: Request) -> Response:
+    """Handle incoming Telegram updates by putting them into the `update_queue`"""
+    return await request.app.state.ingestor.handle(request)
+
+
+async def health(request: Request) -> PlainTextResponse:
+    """For the health endpoint, reply with a simple plain text message for the worker serving the probe."""
+    headers = {"X-Worker-Pid": str(os.getpid())}
+    if not request.app.state.application.running:
+        return PlainTextResponse(content="The bot is not running", status_code=503, headers=headers)
+    return PlainTextResponse(content="The bot is still running fine :)", headers=headers)
+
+
+async def ready(request: Request) -> PlainTextResponse:
+    """Readiness probe: fails once the worker serving it is draining, so traffic moves to other instances."""
+    headers = {"X-Worker-Pid": str(os.getpid())}
+    if request.app.state.drain.draining:
+        return PlainTextResponse(content="The bot is draining", status_code=503, headers=headers)
+    if not request.app.state.application.running:
+        return PlainTextResponse(content="The bot is not running", status_code=503, headers=headers)
+    return PlainTextResponse(content="The bot is ready", headers=headers)
+
+
+async def stats(request: Request) -> JSONResponse:
+    """Reports the update queue, shed or poll, and cache counters of the worker serving the request."""
+    application = request.app.state.application
+    return JSONResponse({"pid": os.getpid(), **request.app.state.ingestor.stats(), "answer_cache": answer_cache.stats(),
+                         "single_flight": single_flight.stats(), "voice_file_cache": voice_file_cache.stats(),
+                         "backends": backend_guard_stats(), "backend_pools": backend_pool_stats(),
+                         "persistence": application.persistence.stats(),
+                         "update_processor": application.update_processor.stats(),
+                         "drain": request.app.state.drain.stats(),
+                         "send_scheduler": application.bot.rate_limiter.stats()})
+
+
+async def metrics(request: Request) -> Response:
+    """Prometheus metrics, added up over the worker processes of this instance."""
+    sample_metrics()
+    # Reading every worker's metric files is disk IO, kept off the event loop
+    body = await asyncio.get_running_loop().run_in_executor(None, render)
+    return Response(body, media_type=CONTENT_TYPE_LATEST)
+
+
+def is_admin_request(request: Request) -> bool:
+    """True if the request carries `Authorization: Bearer <ADMIN_TOKEN>` and ADMIN_TOKEN is set."""
+    if not ADMIN_TOKEN:
+        return False
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+async def reload_config(request: Request) -> Response:
+    """Reloads config.ini in every worker. An invalid file is reported and the running settings are kept."""
+    if not is_admin_request(request):
+        # Not found rather than unauthorized, so the endpoint is not advertised
+        return PlainTextResponse("Not Found", status_code=404)
+    try:
+        await request.app.state.config_reloader.reload()
+    except ValueError as e:
+        logger.error({"category": "config_reload", "label": "invalid_config", "error": str(e)})
+        return JSONResponse({"pid": os.getpid(), "reloaded": False, "error": str(e)}, status_code=500)
+    return JSONResponse({"pid": os.getpid(), "reloaded": True})
 
-    async def health(_: Request) -> PlainTextResponse:
-        """For the health endpoint, reply with a simple plain text message."""
-        return PlainTextResponse(content="The bot is still running fine :)")
 
-    starlette_app = Starlette(
-        routes=[
-            Route("/telegram", telegram, methods=["POST"]),
-            Route("/healthcheck", health, methods=["GET"]),
-        ]
-    )
-    webserver = uvicorn.Server(
-        config=uvicorn.Config(
-            app=starlette_app,
+async def drain(request: Request) -> Response:
+    """
+    Takes every worker of this instance out of rotation ahead of a shutdown. With `?wait=<seconds>`,
+    also waits up to that long for the worker serving the request to handle its backlog.
+    """
+    if not is_admin_request(request):
+        return PlainTextResponse("Not Found", status_code=404)
+    try:
+        wait = float(request.query_params.get("wait", "0"))
+    except ValueError:
+        return PlainTextResponse("wait must be a number of seconds", status_code=400)
+    drain_controller = request.app.state.drain
+    await drain_controller.drain()
+    drained = await drain_controller.wait(wait) if wait > 0 else drain_controller.backlog == 0
+    return JSONResponse({"pid": os.getpid(), "draining": True, "drained": drained,
+                         "backlog": drain_controller.backlog})
+
+
+def create_app() -> Starlette:
+    """Application factory used by every uvicorn worker process."""
+    routes = [
+        Route("/healthcheck", health, methods=["GET"]),
+        Route("/ready", ready, methods=["GET"]),
+        Route("/stats", stats, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/admin/reload_config", reload_config, methods=["POST"]),
+        Route("/admin/drain", drain, methods=["POST"]),
+    ]
+    if TELEGRAM_TRANSPORT != "polling":
+        routes.insert(0, Route("/telegram", telegram, methods=["POST"]))
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+def main() -> None:
+    """
+    Set the webhook once and serve it from `UVICORN_WORKERS` worker processes sharing one port.
+    With TELEGRAM_TRANSPORT=polling, a single worker polls for updates and the port only serves
+    the health, stats, metrics and admin endpoints.
+    """
+    if TELEGRAM_TRANSPORT not in ("webhook", "polling"):
+        raise ValueError(f"TELEGRAM_TRANSPORT must be webhook or polling, not '{TELEGRAM_TRANSPORT}'")
+    logger.info('################################################')
+    logger.info('# Telegram bot name %s', botName)
+    logger.info('# Transport %s', TELEGRAM_TRANSPORT)
+    logger.info('# Worker processes %s', workers)
+    logger.info('################################################')
+    if TELEGRAM_TRANSPORT == "webhook":
+        asyncio.run(set_webhook())
+    # Each worker writes its metrics there, and /metrics adds up those of all of them
+    metrics_dir = prepare_multiprocess_dir() if workers > 1 else None
+
+    # uvicorn's supervisor binds the port once and hands the socket to each worker.
+    # Worker processes re-import this module, so the factory has to be passed by name.
+    try:
+        uvicorn.run(
+            "telegram_webhook:create_app" if workers > 1 else create_app,
+            factory=True,
             port=8000,
             use_colors=False,
+            # uvicorn's own loggers then propagate to the queue handler set up in logger.py
+            log_config=None,
             host="0.0.0.0",
-            workers=workers
+            workers=workers,
         )
-    )
-
-    # Run application and webserver together
-    async with application:
-        await application.start()
-        await webserver.serve()
-        await application.stop()
+    finally:
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
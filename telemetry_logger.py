@@ -1,68 +1,172 @@
-import requests
+import asyncio
+import httpx
 import time
 import os
 import uuid
+from typing import Optional
 from logger import logger
-from config_util import get_config_value
-
-telemetryURL = get_config_value('telemetry', 'TELEMETRY_ENDPOINT_URL', None)
-ENV_NAME = get_config_value('telemetry', 'SERVICE_ENVIRONMENT', None)
-TELEMETRY_LOG_ENABLED = get_config_value('telemetry', 'TELEMETRY_LOG_ENABLED', None).lower() == "true"
-telemetry_id = get_config_value('telemetry', 'service_id', None)
-telemetry_ver = get_config_value('telemetry', 'service_ver', None)
-actor_id = get_config_value('telemetry', 'actor_id', None)
-channel = get_config_value('telemetry', 'channel', None)
-pdata_id = get_config_value('telemetry', 'pdata_id', None)
-events_threshold = get_config_value('telemetry', 'events_threshold', None)
+from config_util import get_settings
+from http_client import post_json
+
+# Seconds shutdown waits for the queued events to be sent before dropping the rest
+telemetry_stop_timeout = float(os.getenv('TELEMETRY_STOP_TIMEOUT', '10'))
+
+_STOP = object()
+
 
 class TelemetryLogger:
     """
-    A class to capture and send telemetry logs using the requests library with threshold limit.
+    A class to capture telemetry events and send them in batches from a background task.
+
+    Events are put on a bounded queue and a single flusher task sends them once
+    `threshold` events are collected or `flush_interval` seconds have passed since the
+    first event of the batch, whichever comes first.
+
+    Whether telemetry is enabled, the endpoint and the event fields follow the current
+    settings, so a configuration reload applies to the next event. Arguments left as
+    None are taken from the settings once, at construction.
     """
 
-    def __init__(self, url=telemetryURL, threshold=int(events_threshold)):
-        self.url = url
-        self.events = []  # Store multiple events before exceeding threshold
-        self.threshold = threshold
+    def __init__(self, url: Optional[str] = None, threshold: Optional[int] = None,
+                 flush_interval: Optional[float] = None, queue_size: Optional[int] = None,
+                 max_retries: Optional[int] = None, retry_backoff: Optional[float] = None):
+        settings = get_settings().telemetry
+        self._url = url
+        self.threshold = settings.events_threshold if threshold is None else threshold
+        self.flush_interval = settings.flush_interval if flush_interval is None else flush_interval
+        self.queue_size = settings.queue_size if queue_size is None else queue_size
+        self.max_retries = settings.max_retries if max_retries is None else max_retries
+        self.retry_backoff = settings.retry_backoff if retry_backoff is None else retry_backoff
+        self.dropped_events = 0
+        self._queue = None
+        self._flusher_task = None
+        self._sending = 0
+
+    @property
+    def url(self) -> str:
+        return get_settings().telemetry.endpoint_url if self._url is None else self._url
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+        if self._flusher_task is None or self._flusher_task.done():
+            # A flusher that died leaves its queue behind, the new one sends what is in it
+            self._flusher_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def start(self):
+        """Starts the background flusher. Otherwise it is started by the first event."""
+        if get_settings().telemetry.log_enabled:
+            self._ensure_started()
+
+    async def stop(self, timeout=telemetry_stop_timeout):
+        """
+        Flushes the queued events and stops the background flusher. Whatever is not sent
+        within `timeout` seconds, retries included, is dropped and logged.
+        """
+        if self._flusher_task is None:
+            return
+        if self._flusher_task.done():
+            # A flusher that died is started again to send what is still queued
+            self._ensure_started()
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            self._flusher_task.cancel()
+            await asyncio.gather(self._flusher_task, return_exceptions=True)
+            dropped = self._sending + sum(1 for event in self._drop_queued() if event is not _STOP)
+            self.dropped_events += dropped
+            logger.error({"category": "telemetry", "label": "stop_timeout", "timeout": timeout,
+                          "dropped_events": dropped})
+        self._flusher_task = None
+        self._sending = 0
+
+    async def _drain(self):
+        await self._queue.put(_STOP)
+        await asyncio.shield(self._flusher_task)
+
+    def _drop_queued(self):
+        while not self._queue.empty():
+            yield self._queue.get_nowait()
+
+    def pending_events(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
 
     def add_event(self, event):
         """
-        Adds a telemetry event to the log.
+        Adds a telemetry event to the log. Never waits on the telemetry service.
 
         **kwargs:** Keyword arguments containing the event data.
         """
         
-        logger.info(f"Telemetry event: {event}")
+        logger.info({"category": "telemetry", "label": "event", "value": event})
         
-        if not TELEMETRY_LOG_ENABLED:
+        if not get_settings().telemetry.log_enabled:
             return
-        
-        self.events.append(event)   
-        # Send logs if exceeding threshold
-        if len(self.events) >= self.threshold:
-            self.send_logs()
 
-    def send_logs(self):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped_events += 1
+            logger.error({"category": "telemetry", "label": "event_dropped", "dropped_events": self.dropped_events})
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self._queue.get()
+            if event is _STOP:
+                return
+            batch = [event]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.threshold:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is _STOP:
+                    stopping = True
+                    break
+                batch.append(event)
+            self._sending = len(batch)
+            await self.send_logs(batch)
+            self._sending = 0
+            if stopping:
+                return
+
+    async def send_logs(self, events):
         """
-        Sends the captured telemetry logs using the requests library.
+        Sends a batch of telemetry events, retrying with exponential backoff.
+        The batch keeps the same msgid across retries so the service can discard duplicates.
         """
-        try:
-            data = {
-                    "id": telemetry_id,
-                    "ver": telemetry_ver,
-                    "params": {"msgid": str(uuid.uuid4())},
-                    "ets": int(time.time() * 1000),
-                    "events": self.events
-            }
-            headers = {"Content-Type": "application/json"}
-            response = requests.post(self.url + "/v1/telemetry", json=data, headers=headers)
-            response.raise_for_status()
-            logger.debug(f"Telemetry API request data: {data}")
-            logger.info("Telemetry logs sent successfully!")
-            # Reset captured events after sending
-            self.events = []
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error sending telemetry log: {e}", exc_info=True)    
+        if not self.url:
+            logger.error({"category": "telemetry", "label": "no_endpoint", "dropped": len(events)})
+            return False
+        settings = get_settings().telemetry
+        data = {
+                "id": settings.service_id,
+                "ver": settings.service_ver,
+                "params": {"msgid": str(uuid.uuid4())},
+                "ets": int(time.time() * 1000),
+                "events": events
+        }
+        headers = {"Content-Type": "application/json"}
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await post_json(self.url + "/v1/telemetry", data, headers=headers)
+                response.raise_for_status()
+                logger.debug(f"Telemetry API request data: {data}")
+                logger.info("Telemetry logs sent successfully!")
+                return True
+            except httpx.HTTPError as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Error sending telemetry log, dropping {len(events)} events: {e}", exc_info=True)
+                    return False
+                logger.warning(f"Error sending telemetry log (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
 
     def prepare_interect_event(self, eventInput: dict, etype="TOUCH"):
         """
@@ -74,23 +178,24 @@ class TelemetryLogger:
         Returns:
             A dictionary representing the telemetry event data.
         """
+        settings = get_settings().telemetry
         data = {
             "eid": "INTERACT",
             "ets": int(time.time() * 1000),  # Current timestamp
             "ver": "3.1",  # Version
             "mid": f"INTERACT:{round(time.time())}",  # Unique message ID
             "actor": {
-                "id": actor_id,
+                "id": settings.actor_id,
                 "type": "System",
             },
             "context": {
-                "channel": channel,
+                "channel": settings.channel,
                  "pdata": {
-                    "id": pdata_id,
+                    "id": settings.pdata_id,
                     "ver": "1.0",
                     "pid": "telegrambot"
                 },
-                "env": ENV_NAME
+                "env": settings.environment
             },
             "edata": {
                 "type": etype,
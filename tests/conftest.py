@@ -0,0 +1,7 @@
+import os
+import sys
+
+# logger.py reads these at import
+os.environ.setdefault("TELEGRAM_BOT_NAME", "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,21 @@
+import pytest
+
+from config_util import MAX_CATALOG_INDEX, check_catalog_indexes
+
+
+def test_catalog_indexes_accept_entries_repeated_across_packs():
+    check_catalog_indexes([{"value": "story", "index": 0}, {"value": "teacher", "index": 1},
+                           {"value": "story", "index": 0}], "value")
+
+
+@pytest.mark.parametrize("entries", [
+    [{"code": "en"}],
+    [{"code": "en", "index": "1"}],
+    [{"code": "en", "index": -1}],
+    [{"code": "en", "index": MAX_CATALOG_INDEX + 1}],
+    [{"code": "en", "index": 1}, {"code": "bn", "index": 1}],
+    [{"code": "en", "index": 1}, {"code": "en", "index": 2}],
+])
+def test_catalog_indexes_reject_missing_out_of_range_and_duplicate_indexes(entries):
+    with pytest.raises(ValueError):
+        check_catalog_indexes(entries, "code")
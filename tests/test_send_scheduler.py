@@ -0,0 +1,39 @@
+import asyncio
+
+import send_scheduler
+from send_scheduler import PRIORITY_ANSWER, PRIORITY_NORMAL, SendScheduler
+
+
+class SlowRedis:
+    """Grants every token, after a round trip long enough for other sends to queue meanwhile."""
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        await asyncio.sleep(0.05)
+        return [0, 0]
+
+
+def test_shared_grant_survives_a_waiter_queued_ahead_during_the_round_trip(monkeypatch):
+    monkeypatch.setattr(send_scheduler, "get_redis", lambda: SlowRedis())
+
+    async def scenario():
+        scheduler = SendScheduler(namespace="test", workers=4)
+        await scheduler.initialize()
+        sent = []
+
+        async def send(name):
+            sent.append(name)
+
+        try:
+            normal = asyncio.ensure_future(scheduler.process_request(
+                send, ("normal",), {}, "sendMessage", {"chat_id": 1}, PRIORITY_NORMAL))
+            # Queued ahead of the normal send while its grant waits on Redis
+            await asyncio.sleep(0.01)
+            answer = asyncio.ensure_future(scheduler.process_request(
+                send, ("answer",), {}, "sendMessage", {"chat_id": 2}, PRIORITY_ANSWER))
+            await asyncio.wait_for(asyncio.gather(normal, answer), timeout=2)
+        finally:
+            await scheduler.shutdown()
+        assert sorted(sent) == ["answer", "normal"]
+        assert scheduler.queued() == 0
+
+    asyncio.run(scenario())
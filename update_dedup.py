@@ -0,0 +1,70 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+from logger import logger
+from redis_util import get_redis
+
+update_dedup_ttl = int(os.getenv('UPDATE_DEDUP_TTL', '86400'))
+update_dedup_local_size = int(os.getenv('UPDATE_DEDUP_LOCAL_SIZE', '100000'))
+
+
+class UpdateDeduplicator:
+    """
+    Drops Telegram re-deliveries of an update_id that was already accepted.
+
+    A bounded in-process filter catches retries hitting the same worker, and a Redis
+    SET NX with a TTL catches retries landing on another worker or node.
+    """
+
+    def __init__(self, namespace: str, ttl=update_dedup_ttl, local_size=update_dedup_local_size):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local_size = local_size
+        self.duplicates = 0
+        self._seen = OrderedDict()  # update_id -> expires_at
+
+    def _key(self, update_id) -> str:
+        return f"{self.namespace}_update_{update_id}"
+
+    def _seen_locally(self, update_id) -> bool:
+        expires_at = self._seen.get(update_id)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._seen[update_id]
+            return False
+        return True
+
+    def _remember(self, update_id):
+        self._seen[update_id] = time.monotonic() + self.ttl
+        while len(self._seen) > self.local_size:
+            self._seen.popitem(last=False)
+
+    async def is_duplicate(self, update_id: int) -> bool:
+        """Claims `update_id` and returns False, or returns True if it was claimed before."""
+        if self._seen_locally(update_id):
+            self.duplicates += 1
+            return True
+        self._remember(update_id)
+        try:
+            claimed = await get_redis().set(self._key(update_id), 1, nx=True, ex=self.ttl)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            # Fail open: a rare duplicate answer is better than dropping updates
+            logger.error({"category": "update_dedup", "label": "claim_failed", "update_id": update_id, "error": str(e)})
+            return False
+        if not claimed:
+            self.duplicates += 1
+            return True
+        return False
+
+    async def release(self, update_id: int):
+        """Forgets a claimed update_id so that a redelivery of it is processed."""
+        self._seen.pop(update_id, None)
+        try:
+            await get_redis().delete(self._key(update_id))
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.error({"category": "update_dedup", "label": "release_failed", "update_id": update_id, "error": str(e)})
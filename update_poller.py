@@ -0,0 +1,123 @@
+import asyncio
+import os
+
+from telegram import Update
+from telegram.error import InvalidToken, RetryAfter, TelegramError, TimedOut
+from telegram.ext import Application
+
+from logger import logger
+from update_dedup import UpdateDeduplicator
+from webhook_ingestion import update_queue_high_water
+
+# Updates fetched per getUpdates call, 1 to 100
+poll_limit = int(os.getenv('POLL_LIMIT', '100'))
+# Seconds Telegram holds a getUpdates call open while there is nothing to deliver
+poll_timeout = int(os.getenv('POLL_TIMEOUT', '50'))
+poll_error_backoff_max = float(os.getenv('POLL_ERROR_BACKOFF_MAX', '30'))
+# Seconds between backlog checks while the backlog is above the high-water mark
+BACKLOG_WAIT = 0.1
+
+
+class UpdatePoller:
+    """
+    Fetches updates with long polling and feeds them to the application's update queue,
+    the same queue the webhook ingestion fills, so polling gets the same concurrent
+    processing as the webhook.
+
+    A single loop calls getUpdates with up to `limit` updates per call. It stops polling
+    while the backlog is above the high-water mark, leaving updates with Telegram rather
+    than shedding them, and confirms a batch only by asking for the next one, once the
+    batch is in the queue.
+    """
+
+    def __init__(self, application: Application, limit=poll_limit, timeout=poll_timeout,
+                 high_water=update_queue_high_water, deduplicator: UpdateDeduplicator = None,
+                 error_backoff_max=poll_error_backoff_max):
+        self.application = application
+        self.limit = limit
+        self.timeout = timeout
+        self.high_water = high_water
+        self.deduplicator = deduplicator
+        self.error_backoff_max = error_backoff_max
+        self.offset = None
+        self.polls = 0
+        self.accepted = 0
+        self.errors = 0
+        self._task = None
+
+    async def start(self):
+        """Removes any webhook, which would make getUpdates fail, and starts polling."""
+        await self.application.bot.delete_webhook(drop_pending_updates=False)
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        """Stops polling and confirms the last batch, which is already in the update queue."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self.offset is not None:
+            try:
+                # Anything this call returns is not confirmed, Telegram delivers it again
+                await self.application.bot.get_updates(offset=self.offset, limit=1, timeout=0)
+            except TelegramError as e:
+                # Redelivered on the next start, where the deduplicator catches it
+                logger.warning({"category": "update_poller", "label": "confirm_failed", "error": str(e)})
+
+    async def _wait_for_backlog(self):
+        update_queue = self.application.update_queue
+        while update_queue.backlog >= self.high_water:
+            await asyncio.sleep(BACKLOG_WAIT)
+
+    async def _poll_loop(self):
+        bot = self.application.bot
+        update_queue = self.application.update_queue
+        backoff = 0.0
+        while True:
+            await self._wait_for_backlog()
+            try:
+                updates = await bot.get_updates(offset=self.offset, limit=self.limit, timeout=self.timeout,
+                                                allowed_updates=Update.ALL_TYPES)
+            except asyncio.CancelledError:
+                raise
+            except InvalidToken:
+                logger.error({"category": "update_poller", "label": "invalid_token"})
+                raise
+            except TelegramError as e:
+                # Conflict means another process is polling, or a webhook was set again
+                self.errors += 1
+                if isinstance(e, RetryAfter):
+                    retry_after = e.retry_after
+                    delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                elif isinstance(e, TimedOut):
+                    delay = 0.0
+                else:
+                    backoff = min(max(backoff * 2, 1.0), self.error_backoff_max)
+                    delay = backoff
+                logger.warning({"category": "update_poller", "label": "get_updates_failed", "error": str(e),
+                                "retry_in": delay})
+                await asyncio.sleep(delay)
+                continue
+            backoff = 0.0
+            self.polls += 1
+            for update in updates:
+                self.offset = update.update_id + 1
+                if self.deduplicator and await self.deduplicator.is_duplicate(update.update_id):
+                    continue
+                # Waits for room rather than dropping, the high-water check keeps this rare
+                await update_queue.put(update)
+                self.accepted += 1
+
+    def stats(self) -> dict:
+        update_queue = self.application.update_queue
+        return {
+            "update_queue_depth": update_queue.qsize(),
+            "update_backlog": update_queue.backlog,
+            "high_water": self.high_water,
+            "polls": self.polls,
+            "accepted": self.accepted,
+            "errors": self.errors,
+            "duplicates": self.deduplicator.duplicates if self.deduplicator else 0,
+        }
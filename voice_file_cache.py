@@ -0,0 +1,98 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+from telegram import Bot, Voice
+
+from logger import logger
+from redis_util import get_redis
+
+# Telegram keeps a download link valid for at least an hour
+voice_file_cache_ttl = int(os.getenv('VOICE_FILE_CACHE_TTL', '3300'))
+voice_file_cache_local_size = int(os.getenv('VOICE_FILE_CACHE_LOCAL_SIZE', '10000'))
+
+
+class VoiceFileCache:
+    """
+    Resolves voice notes to download URLs, caching `getFile` results by `file_unique_id`
+    so that forwarded and re-sent voice notes skip the Bot API round trip.
+
+    Entries live in a bounded in-process LRU and in Redis, shared by every worker, and
+    expire before Telegram's link does. Only the path relative to the bot's file URL is
+    stored, so the bot token never ends up in Redis.
+    """
+
+    def __init__(self, ttl=voice_file_cache_ttl, local_size=voice_file_cache_local_size):
+        self.ttl = ttl
+        self.local_size = local_size
+        self.hits = 0
+        self.misses = 0
+        self._local = OrderedDict()  # file_unique_id -> (expires_at, file_path)
+
+    @staticmethod
+    def _key(file_unique_id: str) -> str:
+        return f"voice_file_{file_unique_id}"
+
+    def _local_get(self, file_unique_id: str):
+        item = self._local.get(file_unique_id)
+        if item is None:
+            return None
+        expires_at, file_path = item
+        if expires_at < time.monotonic():
+            del self._local[file_unique_id]
+            return None
+        self._local.move_to_end(file_unique_id)
+        return file_path
+
+    def _local_put(self, file_unique_id: str, file_path: str, ttl: float):
+        self._local[file_unique_id] = (time.monotonic() + ttl, file_path)
+        self._local.move_to_end(file_unique_id)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    async def _lookup(self, file_unique_id: str):
+        file_path = self._local_get(file_unique_id)
+        if file_path is not None:
+            return file_path
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.get(self._key(file_unique_id))
+                pipe.ttl(self._key(file_unique_id))
+                payload, remaining = await pipe.execute()
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.error({"category": "voice_file_cache", "label": "get_failed", "error": str(e)})
+            return None
+        if payload is None:
+            return None
+        file_path = payload.decode() if isinstance(payload, bytes) else payload
+        self._local_put(file_unique_id, file_path, remaining if remaining > 0 else self.ttl)
+        return file_path
+
+    async def get_file_url(self, bot: Bot, voice: Voice) -> str:
+        """Returns the download URL of a voice note, calling `getFile` only on a cache miss."""
+        file_path = await self._lookup(voice.file_unique_id)
+        if file_path is not None:
+            self.hits += 1
+            return f"{bot.base_file_url}/{file_path}"
+
+        self.misses += 1
+        url = (await bot.get_file(voice.file_id)).file_path
+        prefix = f"{bot.base_file_url}/"
+        if not url.startswith(prefix):
+            # A local Bot API server returns local paths, which are not worth caching
+            return url
+        file_path = url[len(prefix):]
+        self._local_put(voice.file_unique_id, file_path, self.ttl)
+        try:
+            await get_redis().set(self._key(voice.file_unique_id), file_path, ex=self.ttl)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.error({"category": "voice_file_cache", "label": "put_failed", "error": str(e)})
+        return url
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "local_entries": len(self._local)}
+
+
+voice_file_cache = VoiceFileCache()
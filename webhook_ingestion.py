@@ -0,0 +1,134 @@
+import asyncio
+import hmac
+import json
+import os
+
+from starlette.requests import Request
+from starlette.responses import Response
+from telegram import Update
+from telegram.ext import Application
+
+from logger import logger
+from update_dedup import UpdateDeduplicator
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # orjson is optional, the stdlib decoder is only slower
+    _loads = json.loads
+
+webhook_secret_token = os.getenv('TELEGRAM_WEBHOOK_SECRET_TOKEN', '')
+update_queue_size = int(os.getenv('UPDATE_QUEUE_SIZE', '4096'))
+update_queue_high_water = int(os.getenv('UPDATE_QUEUE_HIGH_WATER', '1024'))
+shed_retry_after = os.getenv('UPDATE_SHED_RETRY_AFTER', '5')
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateQueue(asyncio.Queue):
+    """
+    asyncio.Queue that also counts updates taken off the queue but not yet processed.
+
+    PTB pulls updates off the queue as soon as they arrive and only calls `task_done`
+    once they are handled, so `backlog` is the real amount of outstanding work.
+    """
+
+    def __init__(self, maxsize=update_queue_size):
+        super().__init__(maxsize=maxsize)
+        self.backlog = 0
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self.backlog += 1
+
+    def task_done(self):
+        super().task_done()
+        self.backlog -= 1
+
+
+class UpdateIngestor:
+    """
+    Accepts webhook posts from Telegram: checks the secret token before touching the body,
+    decodes it, drops redeliveries of an update already accepted and enqueues the update,
+    or sheds it with a 503 once the backlog passes the high-water mark so that Telegram
+    delivers it again later.
+    """
+
+    def __init__(self, application: Application, secret_token=webhook_secret_token,
+                 high_water=update_queue_high_water, deduplicator: UpdateDeduplicator = None):
+        self.application = application
+        self.secret_token = secret_token.encode()
+        self.high_water = high_water
+        self.deduplicator = deduplicator
+        self.draining = False
+        self.accepted = 0
+        self.shed = 0
+        self.rejected = 0
+        self.refused_draining = 0
+
+    def _shed(self, backlog) -> Response:
+        self.shed += 1
+        if self.shed % 100 == 1:
+            logger.warning({"category": "webhook_ingestion", "label": "shedding", "backlog": backlog, "shed": self.shed})
+        return Response(status_code=503, headers={"Retry-After": shed_retry_after})
+
+    async def handle(self, request: Request) -> Response:
+        if self.secret_token:
+            received = request.headers.get(SECRET_TOKEN_HEADER, "").encode()
+            if not hmac.compare_digest(received, self.secret_token):
+                self.rejected += 1
+                return Response(status_code=403)
+
+        if self.draining:
+            # Telegram delivers it again later, to a worker that is not shutting down
+            self.refused_draining += 1
+            return Response(status_code=503, headers={"Retry-After": shed_retry_after})
+
+        update_queue = self.application.update_queue
+        backlog = update_queue.backlog
+        if backlog >= self.high_water:
+            return self._shed(backlog)
+
+        try:
+            body = _loads(await request.body())
+        except ValueError:
+            self.rejected += 1
+            return Response(status_code=400)
+        if not isinstance(body, dict):
+            self.rejected += 1
+            return Response(status_code=400)
+        try:
+            update = Update.de_json(data=body, bot=self.application.bot)
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            # A 4xx rather than a 500, so that Telegram does not keep redelivering it
+            self.rejected += 1
+            logger.warning({"category": "webhook_ingestion", "label": "malformed_update",
+                            "update_id": body.get("update_id"), "error": str(e)})
+            return Response(status_code=400)
+
+        update_id = update.update_id
+        if self.deduplicator and update_id is not None and await self.deduplicator.is_duplicate(update_id):
+            # Answer 200 so that Telegram stops redelivering it
+            return Response()
+
+        try:
+            update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            if self.deduplicator and update_id is not None:
+                await self.deduplicator.release(update_id)
+            return self._shed(backlog)
+        self.accepted += 1
+        return Response()
+
+    def stats(self) -> dict:
+        update_queue = self.application.update_queue
+        return {
+            "update_queue_depth": update_queue.qsize(),
+            "update_backlog": update_queue.backlog,
+            "high_water": self.high_water,
+            "accepted": self.accepted,
+            "shed": self.shed,
+            "rejected": self.rejected,
+            "refused_draining": self.refused_draining,
+            "duplicates": self.deduplicator.duplicates if self.deduplicator else 0,
+        }